@@ -0,0 +1,158 @@
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # the draw stage needs a QApplication but no screen
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+from PyQt5 import QtWidgets
+
+from main import SampleSizeSolver, PixelMap, StrataMap, MplCanvas, CountPhasePixels
+
+
+# Count area bounds used for each area type, as fractions of the image size
+def GetCountAreaBounds(countAreaType:str, rows:int, cols:int):
+    shortSide = min(rows, cols)
+    if countAreaType == "Full":
+        return None
+    if countAreaType == "Rectangular":
+        return [cols // 8, rows // 8, 3 * cols // 4, 3 * rows // 4]
+    if countAreaType == "Circular":
+        return [cols // 2, rows // 2, 9 * shortSide // 20]
+    if countAreaType == "Polygon":
+        return [cols // 10, rows // 8, 9 * cols // 10, rows // 10, 4 * cols // 5, 9 * rows // 10, cols // 5, 7 * rows // 8]
+    return [cols // 2, rows // 2, shortSide // 5, 9 * shortSide // 20]
+
+
+# Synthetic two phase grayscale image, a random block tiled out to the requested size so large images are cheap to make
+def MakeImage(megapixels:float, seed:int=0) -> np.ndarray:
+    side = int(np.sqrt(megapixels * 1e6))
+    block = (np.random.default_rng(seed).random((509, 509)) < 0.3).astype(np.uint8) * 255
+    reps = -(-side // 509)
+    return np.tile(block, (reps, reps))[:side, :side]
+
+
+# Run stage once under tracemalloc for its peak memory, then time it over repeats and keep the fastest run, which is the least affected by noise
+def MeasureStage(stage, repeats:int) -> dict:
+    tracemalloc.start()
+    stage()
+    _, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+
+    return {"seconds": min(times), "peakMB": peakBytes / 1024**2}
+
+
+def RunBenchmarks(sizes:list, countAreaTypes:list, strata:str, repeats:int, numFrames:int) -> dict:
+    canvas = MplCanvas(width=5, height=5, dpi=100)
+    results = {}
+
+    for megapixels in sizes:
+        image = MakeImage(megapixels)
+        rows, cols = image.shape
+        pixelMap = PixelMap(image)
+
+        for countAreaType in countAreaTypes:
+            countAreaBounds = GetCountAreaBounds(countAreaType, rows, cols)
+            numStrata, layout = StrataMap.ParseLayout(strata, countAreaType)
+            initialGuesses = np.linspace(0.05, 0.95, numStrata)
+            stages = {}
+
+            stages["strata"] = MeasureStage(lambda: StrataMap(rows, cols, numStrata, countAreaType, countAreaBounds, layout), repeats)
+            strataMap = StrataMap(rows, cols, numStrata, countAreaType, countAreaBounds, layout)
+
+            def Solve():
+                SampleSizeSolver.memo.clear()
+                return SampleSizeSolver.Plan(initialGuesses, strataMap.W_h, 0.02, 0.95)
+            stages["solver"] = MeasureStage(Solve, repeats)
+            _, n_h = Solve()
+
+            def Sample():
+                return strataMap.SampleStrata(n_h, np.random.default_rng(0))
+            stages["sampling"] = MeasureStage(Sample, repeats)
+            rowsSampled, colsSampled, _ = Sample()
+            positions = list(zip(rowsSampled.tolist(), colsSampled.tolist()))[:numFrames]
+
+            stages["reference"] = MeasureStage(lambda: CountPhasePixels(image, strataMap), repeats)
+
+            # Overlay and draw are reported per frame
+            def Overlay():
+                return [pixelMap.GetImageWithGridOverlay(row, col, (50, 225, 248), 50, 0) for row, col in positions]
+            stages["overlay"] = MeasureStage(Overlay, repeats)
+            stages["overlay"]["seconds"] /= len(positions)
+            frames = Overlay()
+
+            def Draw():
+                for frame in frames:
+                    canvas.ShowImage(frame)
+            stages["draw"] = MeasureStage(Draw, repeats)
+            stages["draw"]["seconds"] /= len(frames)
+
+            results[f"{megapixels:g}MP/{countAreaType}"] = stages
+            print(f"{megapixels:g}MP {countAreaType}: " + ", ".join(f"{name} {stage['seconds']*1000:.2f}ms {stage['peakMB']:.1f}MB" for name, stage in stages.items()), flush=True)
+
+        del image, pixelMap
+
+    return results
+
+
+# Stages slower than the baseline by more than the tolerance, or using more memory, are regressions
+# Differences under minSeconds are timer noise and ignored
+def CompareToBaseline(results:dict, baseline:dict, tolerance:float, minSeconds:float=0.001) -> list:
+    regressions = []
+    for case, stages in results.items():
+        for name, stage in stages.items():
+            reference = baseline.get(case, {}).get(name)
+            if reference is None:
+                continue
+            if stage["seconds"] > reference["seconds"] * (1 + tolerance) and stage["seconds"] - reference["seconds"] > minSeconds:
+                regressions.append(f"{case} {name}: {stage['seconds']*1000:.2f}ms vs {reference['seconds']*1000:.2f}ms")
+            if stage["peakMB"] > reference["peakMB"] * (1 + tolerance) + 1:
+                regressions.append(f"{case} {name}: {stage['peakMB']:.1f}MB vs {reference['peakMB']:.1f}MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAFT hot path benchmarks on synthetic images")
+    parser.add_argument("--sizes", default="1,16,100,400", help="comma separated image sizes in megapixels")
+    parser.add_argument("--count-areas", default="Full,Rectangular,Circular,Annular,Polygon", help="comma separated count area types")
+    parser.add_argument("--strata", default="16", help="number of strata N, or a layout RxC of grid rows by columns (rings by sectors for circular and annular areas)")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs of each stage, the fastest is reported")
+    parser.add_argument("--frames", type=int, default=32, help="sample windows rendered and drawn per case")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="stored results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+
+    sizes = [float(size) for size in args.sizes.split(",")]
+    results = RunBenchmarks(sizes, args.count_areas.split(","), args.strata, args.repeats, args.frames)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = CompareToBaseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions against {args.baseline}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
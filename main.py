@@ -1,8 +1,6 @@
 import numpy as np
 import scipy.stats
-import scipy.optimize
 from skimage import io
-from skimage.color import gray2rgb
 import matplotlib
 matplotlib.use("Qt5Agg")
 from PyQt5 import QtWidgets, QtGui, QtCore
@@ -11,73 +9,1267 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
 import os
 import csv
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import socket
+import socketserver
+import time
+import json
+import sqlite3
+import getpass
+import secrets
+from datetime import datetime, timezone
 import cv2
+import tifffile
+
+# Class used to solve for the number of samples needed to achieve a specified precision
+class SampleSizeSolver:
+    memo = {} # (p_st, MOE, confidence) -> neff, kept across measurements
+
+    @staticmethod
+    def HalfWidth(n:int, p_st:float, confidence:float) -> float:
+        # NOTE: scipy CP interval reports expected number of successes
+        lowerCL, upperCL = scipy.stats.binom.interval(confidence, n, p_st)
+        return (upperCL - lowerCL) / (2 * n)
+
+    @classmethod
+    def EffectiveSampleSize(cls, p_st:float, MOE:float, confidence:float) -> int:
+        key = (round(float(p_st), 12), round(float(MOE), 12), round(float(confidence), 12))
+        if key in cls.memo:
+            return cls.memo[key]
+
+        if MOE <= 0:
+            raise ValueError(f"MOE must be positive, got {MOE}")
+
+        # Start from the normal approximation, then bracket the smallest n whose half width is within MOE
+        z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+        upper = max(1, int(z**2 * p_st * (1 - p_st) / MOE**2))
+        lower = 0
+        if cls.HalfWidth(upper, p_st, confidence) > MOE:
+            while cls.HalfWidth(upper, p_st, confidence) > MOE:
+                lower = upper
+                upper *= 2
+        else:
+            lower = upper // 2
+            while lower > 0 and cls.HalfWidth(lower, p_st, confidence) <= MOE:
+                upper = lower
+                lower //= 2
+
+        # Bisect the bracket, half width is monotone in n apart from small discreteness steps
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            if cls.HalfWidth(middle, p_st, confidence) <= MOE:
+                upper = middle
+            else:
+                lower = middle
+
+        cls.memo[key] = upper
+        return upper
+
+    @staticmethod
+    def StratumSampleSize(neff:float, p_st:float, W_h, initialGuesses:np.ndarray) -> int:
+        # Closed form solution of neff = p_st*q_st / sum(W_h**2 * p_h*q_h / (n_h-1)) for equal n_h
+        strataVariance = np.sum(W_h**2 * initialGuesses * (1 - initialGuesses))
+        if strataVariance == 0 or p_st * (1 - p_st) == 0:
+            return 2
+
+        return int(np.ceil(1 + neff * strataVariance / (p_st * (1 - p_st))))
+
+    @staticmethod
+    def NeymanSampleSizes(neff:float, p_st:float, W_h, initialGuesses:np.ndarray) -> np.ndarray:
+        # Smallest total sample meeting neff = p_st*q_st / sum(W_h**2 * p_h*q_h / (n_h-1)), n_h-1 proportional to W_h*S_h
+        S_h = np.sqrt(initialGuesses * (1 - initialGuesses))
+        if np.sum(W_h * S_h) == 0 or p_st * (1 - p_st) == 0:
+            return np.full(len(W_h), 2, dtype=np.int64)
+
+        targetVariance = p_st * (1 - p_st) / neff
+        m_h = W_h * S_h * np.sum(W_h * S_h) / targetVariance
+        return np.maximum(2, 1 + np.ceil(m_h)).astype(np.int64)
+
+    @staticmethod
+    def WorstCaseGuesses(initialGuesses:np.ndarray, numPhases:int) -> np.ndarray:
+        # Guesses are for the first phase, the other phases split the rest of each stratum in an unknown way so any one of them may hold all of it
+        # Each stratum is planned for whichever phase could have the largest p(1-p)
+        initialGuesses = np.asarray(initialGuesses, dtype=float)
+        if numPhases <= 2:
+            return initialGuesses # the only other phase is the complement, which has the same variance
+        other = np.minimum(1 - initialGuesses, 0.5)
+        return np.where(other * (1 - other) > initialGuesses * (1 - initialGuesses), other, initialGuesses)
+
+    @classmethod
+    def Plan(cls, initialGuesses:np.ndarray, W_h, MOE:float, confidence:float, allocation:str="Equal") -> tuple:
+        # neff and the number of samples in each stratum for the given initial guesses
+        numStrata = len(initialGuesses)
+        initialStrataProportion = np.sum(W_h * initialGuesses)
+        
+        if initialStrataProportion > 0.5 and MOE > 1-initialStrataProportion:
+            MOE = ((1-initialStrataProportion)+MOE) / 2 # want to keep +- MOE as close as possible on the open side. so if p=0.01, with 5% MOE, the CI should be (0,0.06)
+            print(f"MOE stretches beyond range of [0,1] based on initial guess, reducing to {initialStrataProportion:.2f}")
+        elif initialStrataProportion < 0.5 and MOE > initialStrataProportion:
+            MOE = (initialStrataProportion + MOE) / 2
+            print(f"MOE stretches beyond range of [0,1] based on initial guess, reducing to {initialStrataProportion:.2f}")
+        
+        p_st = np.sum(W_h * initialGuesses)
+        neff = cls.EffectiveSampleSize(p_st, MOE, confidence)
+        neff = np.ceil(neff/ numStrata) * numStrata
+
+        if allocation == "Neyman":
+            n_h = cls.NeymanSampleSizes(neff, p_st, W_h, initialGuesses)
+        else:
+            n_h = cls.StratumSampleSize(neff, p_st, W_h, initialGuesses)
+            n_h = np.full(numStrata, n_h, dtype=np.int64)
+
+        return neff, n_h
+
+    @staticmethod
+    def CheckFits(n_h:np.ndarray, N_h:np.ndarray):
+        # Points are distinct pixels, so no stratum can be planned more points than it has pixels
+        tooSmall = np.flatnonzero(n_h > N_h)
+        if len(tooSmall) > 0:
+            i = tooSmall[0]
+            raise ValueError(f"Stratum {i+1} has {N_h[i]} pixels but the plan needs {n_h[i]} points from it. Use a larger MOE, fewer strata or a larger count area.")
+
+
+# Class used to time hot path stages and keep rolling latency histograms, disabled by default
+# When disabled Now returns None and Record returns immediately, so instrumented code pays only a function call
+class LatencyProfiler:
+    def __init__(self, maxSamples:int=2000):
+        self.enabled = False
+        self.outputPath = None
+        self.maxSamples = maxSamples
+        self.samples = OrderedDict() # stage -> deque of the most recent durations in seconds
+        self.lock = threading.Lock() # prefetch threads record while the overlay reads
+
+    def Enable(self, outputPath:str=None):
+        self.enabled = True
+        self.outputPath = outputPath
+
+    def Now(self):
+        return time.perf_counter() if self.enabled else None
+
+    def Record(self, stage:str, startTime):
+        if startTime is None:
+            return
+        duration = time.perf_counter() - startTime
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.maxSamples)
+            self.samples[stage].append(duration)
+
+    def GetSummary(self) -> dict:
+        # stage -> count, mean, p50, p95 and p99 in milliseconds
+        with self.lock:
+            samples = [(stage, list(durations)) for stage, durations in self.samples.items()]
+
+        summary = {}
+        for stage, durations in samples:
+            durations = np.array(durations) * 1000
+            if len(durations) == 0:
+                continue
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            summary[stage] = {"count": len(durations), "mean": float(np.mean(durations)), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+        return summary
+
+    def GetSummaryText(self) -> str:
+        return "\n".join(f"{stage}: p50 {s['p50']:.1f} / p95 {s['p95']:.1f} / p99 {s['p99']:.1f} ms (n={s['count']})" for stage, s in self.GetSummary().items())
+
+    def Dump(self):
+        if not self.enabled or self.outputPath is None:
+            return
+        with open(self.outputPath, "w") as file:
+            json.dump(self.GetSummary(), file, indent=2)
+
+
+profiler = LatencyProfiler()
 
-# TODO: Make it so that non-square grids can be used for full and rectangular crop (e.g., 8 strata turned into 4x2 grid)
 
 # Class used to aid in displaying the image with grid overlayed onto sampled pixels
 class PixelMap:
     def __init__(self,image:np.ndarray):
-        self.rows = len(image)
-        self.cols = len(image[0])
+        self.rows = image.shape[0]
+        self.cols = image.shape[1]
         self.numPixels = self.rows * self.cols
-        self.originalImage = image # grayscale or rgb
+        self.originalImage = image # grayscale or rgb, kept in its decoded type and never modified
 
-        if np.max(image) <= 1.0:
-            self.originalImage *= 255
-            self.originalImage = self.originalImage.astype(int)
+        # Scaling to 8 bits is only applied to the windows that get displayed
+        # Lazily read images take their maximum from a 4x4 grid of small windows rather than decoding every pixel
+        if image.dtype == np.uint8:
+            self.displayScale = None
+        else:
+            if type(image) is np.ndarray:
+                maxValue = float(np.max(image))
+            else:
+                windowTops = np.linspace(0, max(self.rows - 256, 0), 4).astype(int)
+                windowLefts = np.linspace(0, max(self.cols - 256, 0), 4).astype(int)
+                maxValue = max(float(np.max(image[top:top+256, left:left+256])) for top in windowTops for left in windowLefts)
+            self.displayScale = 255 if maxValue <= 1.0 else 255 / maxValue
+
+    # Convert a window of the original image to uint8 for display
+    def ToDisplay(self, window:np.ndarray) -> np.ndarray:
+        if self.displayScale is None:
+            return window
+        return np.clip(window * self.displayScale, 0, 255).astype(np.uint8)
 
     # Overlay a grid onto the original image and return centered around that grid
     def GetImageWithGridOverlay(self, pixelRow:int, pixelCol:int, newColor:tuple, numSurroundingPixels:int, style:int) -> np.ndarray: 
         
-        if len(np.shape(self.originalImage)) == 3 and np.shape(self.originalImage)[2] == 3: # image is rgb
-            displayImage = np.copy(self.originalImage)
-        elif len(np.shape(self.originalImage)) == 3 and np.shape(self.originalImage)[2] == 4: # image is rgba
-            displayImage = np.copy(self.originalImage[:,:,:3])
-        else: # image is grayscale
-            displayImage = gray2rgb(self.originalImage)
-        
+        # Only the displayed window is copied, pixels beyond the image edge are left black
+        # The grid pixel lands at index numSurroundingPixels+1 of the 2*numSurroundingPixels window
+        windowSize = 2*numSurroundingPixels
+        windowTop = pixelRow - numSurroundingPixels - 1
+        windowLeft = pixelCol - numSurroundingPixels - 1
+
+        topBound = max(windowTop, 0)
+        bottomBound = min(windowTop + windowSize, self.rows)
+        leftBound = max(windowLeft, 0)
+        rightBound = min(windowLeft + windowSize, self.cols)
+
+        displayImage = np.zeros((windowSize, windowSize, 3), dtype=np.uint8)
+        window = self.ToDisplay(self.originalImage[topBound:bottomBound, leftBound:rightBound])
+        if window.ndim == 2: # image is grayscale
+            window = window[:, :, None]
+        displayImage[topBound-windowTop:bottomBound-windowTop, leftBound-windowLeft:rightBound-windowLeft] = window[:, :, :3] # drops alpha of rgba
+
         # Center
-        if style == 0:
-            displayImage[pixelRow][pixelCol] = newColor
+        crosshair = [(0, 0)] if style == 0 else []
 
+        # above, below, right and left arms
         minValue = 1 if style != 2 else 2
-        
-        # above
-        maxVal = 3 if pixelRow > 2 else pixelRow
-        for i in range(minValue, maxVal):
-            displayImage[pixelRow-i][pixelCol] = newColor
-
-        # below
-        maxVal = 3 if pixelRow < self.rows-3 else self.rows-pixelRow
-        for i in range(minValue, maxVal):
-            displayImage[pixelRow+i][pixelCol] = newColor
-
-        # right
-        maxVal = 3 if pixelCol < self.cols-3 else self.cols-pixelCol
-        for i in range(minValue, maxVal):
-            displayImage[pixelRow][pixelCol+i] = newColor
-
-        # left
-        maxVal = 3 if pixelCol > 2 else pixelCol
-        for i in range(minValue, maxVal):
-            displayImage[pixelRow][pixelCol-i] = newColor
-        
-        # pad image to ensure display proper
-        displayImage = np.pad(displayImage, ((numSurroundingPixels+1, numSurroundingPixels+1), (numSurroundingPixels+1, numSurroundingPixels+1), (0,0)))
+        for i in range(minValue, 3):
+            crosshair += [(-i, 0), (i, 0), (0, i), (0, -i)]
 
-        # Crop the image to center around the grid with numSurroundingPixels around
-        displayImage = displayImage[pixelRow:pixelRow+2*numSurroundingPixels,pixelCol:pixelCol+2*numSurroundingPixels,:]
+        for rowOffset, colOffset in crosshair:
+            row = pixelRow + rowOffset
+            col = pixelCol + colOffset
+            if 0 <= row < self.rows and 0 <= col < self.cols:
+                displayImage[row-windowTop, col-windowLeft] = newColor
 
         return displayImage
 
-    def GetCroppedImage(self, leftBound, rightBound, topBound, bottomBound):
-        return self.originalImage[topBound:bottomBound, leftBound:rightBound]
+    def GetCroppedImage(self, leftBound, rightBound, topBound, bottomBound, step=1):
+        return self.ToDisplay(self.originalImage[topBound:bottomBound:step, leftBound:rightBound:step])
     
     def GetCroppedAndMaskedImage(self, leftBound, rightBound, topBound, bottomBound, polygonPoints):
         return self.originalImage[topBound:bottomBound, leftBound:rightBound]
 
 
+# Class used to describe which stratum each pixel of the count area belongs to
+class StrataMap:
+    def __init__(self, rows:int, cols:int, numStrata:int, countAreaType:str, countAreaBounds=None, layout=None):
+        # layout is (grid rows, grid columns) for full, rectangular and polygon areas and (rings, sectors) for circular and annular ones
+        # Grid cells that fall outside a polygon are dropped, so a polygon area can end up with fewer strata than the layout
+        if layout is None:
+            layout = self.GetDefaultLayout(numStrata, countAreaType)
+        if countAreaType != "Polygon" and layout[0] * layout[1] != numStrata:
+            raise ValueError(f"Strata layout {layout[0]}x{layout[1]} does not give {numStrata} strata.")
+
+        self.rows = rows
+        self.cols = cols
+        self.numStrata = numStrata
+        self.layout = (int(layout[0]), int(layout[1]))
+        self.countAreaType = countAreaType
+        self.countAreaBounds = countAreaBounds
+        self.labels = None # compact label array over the count area bounding box, only needed for circular and annular
+        self.labelType = np.int8 if layout[0] * layout[1] < 128 else np.int16
+
+        if countAreaType == "Full" or countAreaType == "Rectangular":
+            # countAreaBounds is [top left x, top left y, width, height]
+            left, top, width, height = (0, 0, cols, rows) if countAreaType == "Full" else countAreaBounds
+
+            numGridRows, numGridCols = self.layout
+            self.rowEdges = top + (np.arange(numGridRows+1) * height) // numGridRows
+            self.colEdges = left + (np.arange(numGridCols+1) * width) // numGridCols
+
+            strataRows, strataCols = np.unravel_index(np.arange(numStrata), (numGridRows, numGridCols))
+            self.topBounds = self.rowEdges[strataRows]
+            self.bottomBounds = self.rowEdges[strataRows+1]
+            self.leftBounds = self.colEdges[strataCols]
+            self.rightBounds = self.colEdges[strataCols+1]
+
+            self.counts = (self.bottomBounds - self.topBounds) * (self.rightBounds - self.leftBounds)
+        elif countAreaType == "Polygon":
+            # countAreaBounds is [x0, y0, x1, y1, ...], the polygon vertices in order
+            vertices = np.asarray(countAreaBounds, dtype=np.int64).reshape(-1, 2)
+            if len(vertices) < 3:
+                raise ValueError("A polygon count area needs at least 3 vertices.")
+            vertices[:, 0] = np.clip(vertices[:, 0], 0, cols - 1)
+            vertices[:, 1] = np.clip(vertices[:, 1], 0, rows - 1)
+
+            self.boxTop = int(np.min(vertices[:, 1]))
+            self.boxBottom = int(np.max(vertices[:, 1])) + 1
+            self.boxLeft = int(np.min(vertices[:, 0]))
+            self.boxRight = int(np.max(vertices[:, 0])) + 1
+            height = self.boxBottom - self.boxTop
+            width = self.boxRight - self.boxLeft
+
+            # Rasterize the polygon once over its bounding box
+            inside = np.zeros((height, width), dtype=np.uint8)
+            cv2.fillPoly(inside, [(vertices - [self.boxLeft, self.boxTop]).astype(np.int32)], 1)
+
+            # Label every inside pixel with its cell of a grid over the bounding box
+            numGridRows, numGridCols = self.layout
+            self.rowEdges = self.boxTop + (np.arange(numGridRows+1) * height) // numGridRows
+            self.colEdges = self.boxLeft + (np.arange(numGridCols+1) * width) // numGridCols
+            cellRows = np.searchsorted(self.rowEdges, np.arange(self.boxTop, self.boxBottom), side="right") - 1
+            cellCols = np.searchsorted(self.colEdges, np.arange(self.boxLeft, self.boxRight), side="right") - 1
+            labelType = self.labelType
+            self.labels = np.empty((height, width), dtype=labelType)
+            bandRows = max(1, 2**22 // max(width, 1))
+            cellCounts = np.zeros(numGridRows * numGridCols, dtype=np.int64)
+            for bandStart in range(0, height, bandRows):
+                band = np.add.outer((cellRows[bandStart:bandStart + bandRows] * numGridCols).astype(labelType), cellCols.astype(labelType))
+                band[inside[bandStart:bandStart + bandRows] == 0] = -1
+                self.labels[bandStart:bandStart + len(band)] = band
+                cellCounts += np.bincount(band.ravel() + 1, minlength=numGridRows * numGridCols + 1)[1:]
+
+            # Compact the cells into strata. Empty cells are dropped and slivers cut off by the polygon edge are merged into the nearest full sized cell
+            occupied = cellCounts > 0
+            if not np.any(occupied):
+                raise ValueError("The polygon count area contains no pixels.")
+            kept = cellCounts >= 0.1 * np.mean(cellCounts[occupied])
+            keptCells = np.flatnonzero(kept)
+            gridRows, gridCols = np.divmod(np.arange(numGridRows * numGridCols), numGridCols)
+            distances = (gridRows[:, None] - gridRows[keptCells][None, :])**2 + (gridCols[:, None] - gridCols[keptCells][None, :])**2
+            cellToStratum = np.where(occupied, np.argmin(distances, axis=1), -1).astype(labelType)
+            for bandStart in range(0, height, bandRows):
+                band = self.labels[bandStart:bandStart + bandRows]
+                self.labels[bandStart:bandStart + len(band)] = np.where(band >= 0, cellToStratum[band], -1)
+
+            self.numStrata = len(keptCells)
+            self.counts = np.bincount(cellToStratum[occupied], weights=cellCounts[occupied], minlength=self.numStrata).astype(np.int64)
+
+            # Bounding box of each stratum is the union of its cells clipped to the polygon bounding box
+            cellTops, cellBottoms = self.rowEdges[gridRows], self.rowEdges[gridRows+1]
+            cellLefts, cellRights = self.colEdges[gridCols], self.colEdges[gridCols+1]
+            self.topBounds = np.full(self.numStrata, rows)
+            self.bottomBounds = np.zeros(self.numStrata, dtype=int)
+            self.leftBounds = np.full(self.numStrata, cols)
+            self.rightBounds = np.zeros(self.numStrata, dtype=int)
+            np.minimum.at(self.topBounds, cellToStratum[occupied], cellTops[occupied])
+            np.maximum.at(self.bottomBounds, cellToStratum[occupied], cellBottoms[occupied])
+            np.minimum.at(self.leftBounds, cellToStratum[occupied], cellLefts[occupied])
+            np.maximum.at(self.rightBounds, cellToStratum[occupied], cellRights[occupied])
+        else:
+            # countAreaBounds is [center_x, center_y, radius] or [center_x, center_y, inner_radius, outer_radius]
+            if countAreaType == "Circular":
+                centerX, centerY, outerRadius = countAreaBounds
+                innerRadius = 0
+            else:
+                centerX, centerY, innerRadius, outerRadius = countAreaBounds
+
+            # Ring edges split the area equally, stratum i lies in ring i // numSectors and sector i % numSectors
+            numRings, numSectors = self.layout
+            ringRadii = np.sqrt(innerRadius**2 + np.arange(numRings+1) / numRings * (outerRadius**2 - innerRadius**2))
+            self.ringRadii = ringRadii
+
+            self.boxTop = max(centerY - outerRadius, 0)
+            self.boxBottom = min(centerY + outerRadius + 1, rows)
+            self.boxLeft = max(centerX - outerRadius, 0)
+            self.boxRight = min(centerX + outerRadius + 1, cols)
+
+            labelType = self.labelType
+            self.labels = np.empty((self.boxBottom - self.boxTop, self.boxRight - self.boxLeft), dtype=labelType)
+
+            # Fill the label array in bands of rows to bound the size of the float temporaries
+            distanceType = np.int32 if outerRadius < 30000 else np.int64
+            dx = (np.arange(self.boxLeft, self.boxRight) - centerX).astype(distanceType)
+            bandRows = max(1, 2**22 // max(len(dx), 1))
+            self.counts = np.zeros(numStrata, dtype=np.int64)
+            for bandStart in range(0, len(self.labels), bandRows):
+                dy = (np.arange(self.boxTop + bandStart, min(self.boxTop + bandStart + bandRows, self.boxBottom)) - centerY).astype(distanceType)[:, None]
+                radiusSquared = dx*dx + dy*dy
+
+                # angle in [0, 2pi) measured the same way as the drawn strata spokes, scaled so its integer part is the sector
+                sector = np.arctan2(-dy.astype(np.float32), -dx.astype(np.float32))
+                sector += np.pi
+                sector *= numSectors / (2 * np.pi)
+                np.minimum(sector, numSectors - 1, out=sector)
+
+                band = sector.astype(labelType)
+                if numRings > 1:
+                    # rings are equal area so the ring index is linear in the squared radius
+                    ring = radiusSquared.astype(np.float32)
+                    ring -= innerRadius**2
+                    ring *= numRings / (outerRadius**2 - innerRadius**2)
+                    np.clip(ring, 0, numRings - 1, out=ring)
+                    band += ring.astype(labelType) * labelType(numSectors)
+                band[radiusSquared > outerRadius**2] = -1
+                if innerRadius > 0:
+                    band[radiusSquared < innerRadius**2] = -1
+                self.labels[bandStart:bandStart + len(band)] = band
+                self.counts += np.bincount(band.ravel() + 1, minlength=numStrata+1)[1:]
+
+            # Bounding box of each stratum from its arc end points, the axis crossings inside it and the center side corners
+            ringIndex, sectorIndex = np.divmod(np.arange(numStrata), numSectors)
+            theta1 = (sectorIndex * 2 * np.pi / numSectors)[:, None]
+            theta2 = ((sectorIndex + 1) * 2 * np.pi / numSectors)[:, None]
+            innerRadii = ringRadii[ringIndex][:, None]
+            outerRadii = ringRadii[ringIndex + 1][:, None]
+            axisAngles = np.arange(5)[None, :] * np.pi / 2
+            axisAngles = np.where((axisAngles > theta1) & (axisAngles < theta2), axisAngles, theta1)
+            angles = np.hstack([theta1, theta2, theta1, theta2, axisAngles])
+            radii = np.hstack([np.repeat(outerRadii, 2, axis=1), np.repeat(innerRadii, 2, axis=1), np.repeat(outerRadii, 5, axis=1)])
+            xs = centerX + radii * np.cos(angles)
+            ys = centerY + radii * np.sin(angles)
+            self.topBounds = np.clip(np.floor(ys.min(axis=1)).astype(int), 0, rows)
+            self.bottomBounds = np.clip(np.ceil(ys.max(axis=1)).astype(int) + 1, 0, rows)
+            self.leftBounds = np.clip(np.floor(xs.min(axis=1)).astype(int), 0, cols)
+            self.rightBounds = np.clip(np.ceil(xs.max(axis=1)).astype(int) + 1, 0, cols)
+
+        self.N = int(np.sum(self.counts))
+        self.W_h = self.counts / self.N
+
+    @staticmethod
+    def GetDefaultLayout(numStrata:int, countAreaType:str) -> tuple:
+        # Grids are as close to square as numStrata allows, circular and annular areas are split into sectors only
+        if countAreaType == "Circular" or countAreaType == "Annular":
+            return (1, numStrata)
+        numGridRows = max(d for d in range(1, int(np.sqrt(numStrata)) + 1) if numStrata % d == 0)
+        return (numGridRows, numStrata // numGridRows)
+
+    @classmethod
+    def ParseLayout(cls, text:str, countAreaType:str, defaultStrata:int=16) -> tuple:
+        # "N" gives N strata in the default layout, "RxC" gives R grid rows (or rings) by C grid columns (or sectors)
+        text = text.strip().lower()
+        if text == "":
+            return defaultStrata, cls.GetDefaultLayout(defaultStrata, countAreaType)
+        parts = text.split("x")
+        if not all(part.strip().isdigit() for part in parts):
+            raise ValueError(f"Strata layout must be N or RxC with whole numbers, got {text}.")
+        if len(parts) == 1:
+            numStrata = int(parts[0])
+            layout = cls.GetDefaultLayout(numStrata, countAreaType) if numStrata > 0 else (0, 0)
+        elif len(parts) == 2:
+            layout = (int(parts[0]), int(parts[1]))
+            numStrata = layout[0] * layout[1]
+        else:
+            raise ValueError(f"Strata layout must be N or RxC, got {text}.")
+        if layout[0] < 1 or layout[1] < 1 or numStrata > 32767:
+            raise ValueError(f"Strata layout {text} must have between 1 and 32767 strata.")
+        return numStrata, layout
+
+    def GetBounds(self, stratumIndex:int) -> tuple:
+        # left, right, top, bottom bounds of the rectangle containing the stratum
+        return (int(self.leftBounds[stratumIndex]), int(self.rightBounds[stratumIndex]), int(self.topBounds[stratumIndex]), int(self.bottomBounds[stratumIndex]))
+
+    def GetLabels(self, leftBound:int, rightBound:int, topBound:int, bottomBound:int) -> np.ndarray:
+        # Stratum index of every pixel in the window, -1 outside the count area
+        if self.labels is None:
+            numGridRows, numGridCols = self.layout
+            strataRows = np.searchsorted(self.rowEdges, np.arange(topBound, bottomBound), side="right") - 1
+            strataCols = np.searchsorted(self.colEdges, np.arange(leftBound, rightBound), side="right") - 1
+            rowLabels = (np.clip(strataRows, 0, numGridRows-1) * numGridCols).astype(self.labelType)
+            colLabels = np.clip(strataCols, 0, numGridCols-1).astype(self.labelType)
+            labels = np.add.outer(rowLabels, colLabels)
+            labels[(strataRows < 0) | (strataRows >= numGridRows), :] = -1
+            labels[:, (strataCols < 0) | (strataCols >= numGridCols)] = -1
+            return labels
+
+        labels = np.full((bottomBound - topBound, rightBound - leftBound), -1, dtype=self.labels.dtype)
+        top = max(topBound, self.boxTop)
+        bottom = min(bottomBound, self.boxBottom)
+        left = max(leftBound, self.boxLeft)
+        right = min(rightBound, self.boxRight)
+        if top < bottom and left < right:
+            labels[top-topBound:bottom-topBound, left-leftBound:right-leftBound] = self.labels[top-self.boxTop:bottom-self.boxTop, left-self.boxLeft:right-self.boxLeft]
+
+        return labels
+
+    def SampleStrata(self, n_h, rng:np.random.Generator) -> tuple:
+        # Random (rows, cols, strata) of n_h[i] distinct pixels from every stratum i, grouped by stratum
+        # Candidates for all strata are drawn in one batch from their bounding boxes and rejected against the label map
+        n_h = np.asarray(n_h, dtype=np.int64)
+        for i in np.flatnonzero(self.counts < n_h):
+            raise ValueError(f"Not enough pixels in stratum {i} to sample {n_h[i]} points.")
+
+        boxWidths = (self.rightBounds - self.leftBounds).astype(np.int64)
+        boxAreas = (self.bottomBounds - self.topBounds).astype(np.int64) * boxWidths
+        acceptance = self.counts / np.maximum(boxAreas, 1)
+
+        # Strata too sparse in their box for rejection to pay off are enumerated instead
+        sparse = (n_h > 0) & (1.2 * n_h / np.maximum(acceptance, 1e-12) + 16 >= boxAreas) & (self.labels is not None)
+        sparseStrata, sparseIndices = [], []
+        for i in np.flatnonzero(sparse):
+            leftBound, rightBound, topBound, bottomBound = self.GetBounds(i)
+            members = np.flatnonzero(self.GetLabels(leftBound, rightBound, topBound, bottomBound) == i)
+            sparseIndices.append(rng.choice(members, n_h[i], replace=False))
+            sparseStrata.append(np.full(n_h[i], i))
+        targets = np.where(sparse, 0, n_h)
+
+        strata = np.empty(0, dtype=np.int64)
+        indices = np.empty(0, dtype=np.int64)
+        remaining = targets
+        while np.any(remaining > 0):
+            numCandidates = np.where(remaining > 0, (1.2 * remaining / np.maximum(acceptance, 1e-12)).astype(np.int64) + 16, 0)
+            candidateStrata = np.repeat(np.arange(self.numStrata), numCandidates)
+            candidates = rng.integers(0, boxAreas[candidateStrata])
+            if self.labels is not None:
+                rows = candidates // boxWidths[candidateStrata] + self.topBounds[candidateStrata]
+                cols = candidates % boxWidths[candidateStrata] + self.leftBounds[candidateStrata]
+                inside = self.labels[rows - self.boxTop, cols - self.boxLeft] == candidateStrata
+                candidateStrata, candidates = candidateStrata[inside], candidates[inside]
+
+            # Keep the first draw of every distinct pixel and the first targets[i] of them in each stratum, in draw order
+            strata = np.concatenate([strata, candidateStrata])
+            indices = np.concatenate([indices, candidates])
+            _, firstIndex = np.unique(strata * (int(np.max(boxAreas)) + 1) + indices, return_index=True)
+            firstIndex.sort()
+            strata, indices = strata[firstIndex], indices[firstIndex]
+            order = np.argsort(strata, kind="stable")
+            ranks = np.empty(len(strata), dtype=np.int64)
+            ranks[order] = np.arange(len(strata)) - np.searchsorted(strata[order], strata[order])
+            keep = ranks < targets[strata]
+            strata, indices = strata[keep], indices[keep]
+            remaining = targets - np.bincount(strata, minlength=self.numStrata)
+
+        strata = np.concatenate([strata] + sparseStrata).astype(np.int64)
+        indices = np.concatenate([indices] + sparseIndices).astype(np.int64)
+        order = np.argsort(strata, kind="stable")
+        strata, indices = strata[order], indices[order]
+        rows = indices // boxWidths[strata] + self.topBounds[strata]
+        cols = indices % boxWidths[strata] + self.leftBounds[strata]
+        return rows, cols, strata
+
+
+# Class used to read a tiled (optionally pyramidal) TIFF lazily, only the tiles a requested window touches are decoded
+class TiledImageSource:
+    def __init__(self, imagePath:str, maxBytes:int=512*1024**2):
+        self.tiffFile = tifffile.TiffFile(imagePath)
+        self.levels = [level.keyframe for level in self.tiffFile.series[0].levels] # full resolution first, then pyramid levels
+        self.shape = self.levels[0].shape
+        self.dtype = self.levels[0].dtype
+        self.ndim = len(self.shape)
+        self.maxBytes = maxBytes
+        self.numBytes = 0
+        self.tiles = OrderedDict() # (level, tileIndex) -> decoded tile, least recently used first
+        self.lock = threading.Lock()
+
+    # Supports image[top:bottom, left:right] and strided image[top:bottom:step, left:right:step] like a numpy array
+    def __getitem__(self, key):
+        topBound, bottomBound, rowStep = key[0].indices(self.shape[0])
+        leftBound, rightBound, colStep = key[1].indices(self.shape[1])
+        if rowStep == 1 and colStep == 1:
+            return self.ReadRegion(0, topBound, bottomBound, leftBound, rightBound)
+
+        # Read strided windows from the coarsest pyramid level that still has the requested resolution
+        rows = np.arange(topBound, bottomBound, rowStep)
+        cols = np.arange(leftBound, rightBound, colStep)
+        if len(rows) == 0 or len(cols) == 0:
+            return np.empty((len(rows), len(cols)) + self.shape[2:], dtype=self.dtype)
+
+        level = 0
+        for i, page in enumerate(self.levels):
+            if self.shape[0] / page.shape[0] <= rowStep and self.shape[1] / page.shape[1] <= colStep:
+                level = i
+        page = self.levels[level]
+        rows = np.minimum(rows * page.shape[0] // self.shape[0], page.shape[0] - 1)
+        cols = np.minimum(cols * page.shape[1] // self.shape[1], page.shape[1] - 1)
+
+        return self.ReadSampled(level, rows, cols)
+
+    def ReadRegion(self, level:int, topBound:int, bottomBound:int, leftBound:int, rightBound:int) -> np.ndarray:
+        page = self.levels[level]
+        region = np.zeros((max(bottomBound - topBound, 0), max(rightBound - leftBound, 0)) + self.shape[2:], dtype=self.dtype)
+        tilesAcross = -(-page.shape[1] // page.tilewidth)
+
+        for tileRow in range(topBound // page.tilelength, -(-bottomBound // page.tilelength)):
+            for tileCol in range(leftBound // page.tilewidth, -(-rightBound // page.tilewidth)):
+                tile = self.GetTile(level, tileRow * tilesAcross + tileCol)
+                tileTop = tileRow * page.tilelength
+                tileLeft = tileCol * page.tilewidth
+
+                top = max(topBound, tileTop)
+                bottom = min(bottomBound, tileTop + page.tilelength)
+                left = max(leftBound, tileLeft)
+                right = min(rightBound, tileLeft + page.tilewidth)
+                region[top-topBound:bottom-topBound, left-leftBound:right-leftBound] = tile[top-tileTop:bottom-tileTop, left-tileLeft:right-tileLeft]
+
+        return region
+
+    # Picks the given rows and columns out of each tile as it is decoded, so a strided read never holds the full resolution region
+    def ReadSampled(self, level:int, rows:np.ndarray, cols:np.ndarray) -> np.ndarray:
+        page = self.levels[level]
+        sampled = np.zeros((len(rows), len(cols)) + self.shape[2:], dtype=self.dtype)
+        tilesAcross = -(-page.shape[1] // page.tilewidth)
+        rowTiles = rows // page.tilelength
+        colTiles = cols // page.tilewidth
+
+        for tileRow in np.unique(rowTiles):
+            rowIndices = np.nonzero(rowTiles == tileRow)[0]
+            tileRows = rows[rowIndices] - tileRow * page.tilelength
+            for tileCol in np.unique(colTiles):
+                colIndices = np.nonzero(colTiles == tileCol)[0]
+                tile = self.GetTile(level, int(tileRow * tilesAcross + tileCol))
+                sampled[np.ix_(rowIndices, colIndices)] = tile[np.ix_(tileRows, cols[colIndices] - tileCol * page.tilewidth)]
+
+        return sampled
+
+    def GetTile(self, level:int, tileIndex:int) -> np.ndarray:
+        key = (level, tileIndex)
+        page = self.levels[level]
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+
+            data = None # missing tiles decode to the fill value
+            if page.databytecounts[tileIndex] > 0:
+                self.tiffFile.filehandle.seek(page.dataoffsets[tileIndex])
+                data = self.tiffFile.filehandle.read(page.databytecounts[tileIndex])
+
+        segment, _, _ = page.decode(data, tileIndex, jpegtables=page.jpegtables)
+        tile = segment[0] if self.ndim == 3 else segment[0, :, :, 0] # drop the plane axis, and the sample axis for grayscale
+
+        with self.lock:
+            self.tiles[key] = tile
+            self.numBytes += tile.nbytes
+            while self.numBytes > self.maxBytes and len(self.tiles) > 1:
+                _, evicted = self.tiles.popitem(last=False)
+                self.numBytes -= evicted.nbytes
+
+        return tile
+
+    def Close(self):
+        self.tiffFile.close()
+        self.tiles.clear()
+        self.numBytes = 0
+
+
+# Class used to decode each image once and share it between the setup, initial guess and counting stages
+class ImageStore:
+    def __init__(self, maxBytes:int=2*1024**3, lazyBytes:int=256*1024**2):
+        self.maxBytes = maxBytes
+        self.lazyBytes = lazyBytes # uncompressed TIFFs larger than this are memory mapped instead of decoded
+        self.numBytes = 0
+        self.entries = OrderedDict() # (path, mtime, size) -> {"image", "pixelMap", "numBytes"}, least recently used first
+        self.lock = threading.Lock() # the next queued image is decoded on a background thread
+
+    def GetKey(self, imagePath:str) -> tuple:
+        stat = os.stat(imagePath)
+        return (os.path.abspath(imagePath), stat.st_mtime_ns, stat.st_size)
+
+    def GetEntry(self, imagePath:str) -> dict:
+        key = self.GetKey(imagePath)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        # Decoded outside the lock so the image being counted stays available while the next one decodes
+        startTime = profiler.Now()
+        image = self.OpenImage(imagePath)
+        profiler.Record("decode", startTime)
+        if isinstance(image, np.ndarray):
+            image.flags.writeable = False # every stage gets a read-only view of the same pixels
+
+        with self.lock:
+            if key in self.entries: # decoded on another thread in the meantime
+                if isinstance(image, TiledImageSource):
+                    image.Close()
+                return self.entries[key]
+
+            # Lazy sources only hold their bounded tile cache or mapped pages, so they do not count against the budget
+            entry = {"image": image, "pixelMap": None, "pyramid": None, "numBytes": image.nbytes if type(image) is np.ndarray else 0}
+            self.entries[key] = entry
+            self.numBytes += entry["numBytes"]
+            self.Evict()
+
+        return entry
+
+    def OpenImage(self, imagePath:str):
+        # Tiled TIFFs, large uncompressed TIFFs and .npy files are opened lazily, everything else is decoded into memory
+        if imagePath.lower().endswith(".npy"):
+            return np.load(imagePath, mmap_mode="r")
+
+        if imagePath.lower().endswith((".tif", ".tiff")):
+            with tifffile.TiffFile(imagePath) as tiffFile:
+                series = tiffFile.series[0]
+                page = series.levels[0].keyframe
+                isSingleImage = series.levels[0].shape == page.shape and page.ndim in (2, 3)
+                isTiled = isSingleImage and page.is_tiled and (page.ndim == 2 or page.planarconfig == 1)
+                isContiguous = isSingleImage and page.is_contiguous
+
+            if isTiled:
+                return TiledImageSource(imagePath)
+            if isContiguous and os.path.getsize(imagePath) > self.lazyBytes:
+                return tifffile.memmap(imagePath, mode="r")
+
+        try:
+            return io.imread(imagePath)
+        except OSError:
+            raise
+        except Exception as e: # the decoder plugins raise struct.error, SyntaxError and others on corrupt files
+            raise ValueError(f"cannot decode the image, {e}") from e
+
+    def GetImage(self, imagePath:str) -> np.ndarray:
+        return self.GetEntry(imagePath)["image"]
+
+    def GetPixelMap(self, imagePath:str):
+        entry = self.GetEntry(imagePath)
+        with self.lock:
+            if entry["pixelMap"] is None:
+                entry["pixelMap"] = PixelMap(entry["image"]) # shares the decoded pixels, no extra copy
+
+        return entry["pixelMap"]
+
+    def GetPyramid(self, imagePath:str, maxSize:int=2048, minSize:int=256) -> list:
+        # RGB uint8 previews for selecting the count area, the first no larger than maxSize and every next one half the size
+        entry = self.GetEntry(imagePath)
+        with self.lock:
+            if entry["pyramid"] is not None:
+                return entry["pyramid"]
+
+        pyramid = [self.MakePreview(entry["image"], maxSize)]
+        while max(pyramid[-1].shape[:2]) > minSize:
+            pyramid.append(cv2.pyrDown(pyramid[-1]))
+
+        with self.lock:
+            if entry["pyramid"] is None: # built on another thread in the meantime otherwise
+                entry["pyramid"] = pyramid
+                numBytes = sum(level.nbytes for level in pyramid)
+                entry["numBytes"] += numBytes
+                self.numBytes += numBytes
+                self.Evict()
+        return entry["pyramid"]
+
+    @staticmethod
+    def MakePreview(image, maxSize:int) -> np.ndarray:
+        # Lazily read images are strided first so only a coarse pyramid level or subset of tiles is decoded
+        h, w = image.shape[:2]
+        scale = min(maxSize / max(h, w), 1.0)
+        step = 1 if type(image) is np.ndarray else max(1, int(1 / scale))
+        preview = np.array(image[::step, ::step])
+        if scale < 1.0:
+            preview = cv2.resize(preview, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+        if preview.dtype != np.uint8:
+            preview = cv2.normalize(preview, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+        if preview.ndim == 2:
+            preview = cv2.cvtColor(preview, cv2.COLOR_GRAY2RGB)
+        elif preview.shape[2] == 4:
+            preview = cv2.cvtColor(preview, cv2.COLOR_RGBA2RGB)
+
+        return np.ascontiguousarray(preview)
+
+    def Evict(self):
+        # Drop least recently used images until under budget, always keeping the newest one
+        while self.numBytes > self.maxBytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.numBytes -= entry["numBytes"]
+            if isinstance(entry["image"], TiledImageSource):
+                entry["image"].Close()
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.numBytes = 0
+
+
+# Class used to keep rendered viewports of a sample plan, rendering upcoming ones on a background thread
+class ViewportCache:
+    def __init__(self, pixelMap:PixelMap, samplePositions:list, newColor:tuple, maxBytes:int=256*1024**2):
+        self.pixelMap = pixelMap
+        self.samplePositions = samplePositions
+        self.newColor = newColor
+        self.maxBytes = maxBytes
+        self.numBytes = 0
+        self.frames = OrderedDict() # (gridIndex, numSurroundingPixels, style) -> rendered window, least recently used first
+        self.pending = {} # key -> queued prefetch future
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def Render(self, key:tuple) -> np.ndarray:
+        gridIndex, numSurroundingPixels, style = key
+        pixelRow, pixelCol = self.samplePositions[gridIndex]
+        startTime = profiler.Now()
+        frame = self.pixelMap.GetImageWithGridOverlay(pixelRow, pixelCol, self.newColor, numSurroundingPixels, style)
+        profiler.Record("overlay", startTime)
+        frame.flags.writeable = False
+        return frame
+
+    def Store(self, key:tuple, frame:np.ndarray):
+        with self.lock:
+            if key in self.frames:
+                return
+            self.frames[key] = frame
+            self.numBytes += frame.nbytes
+            while self.numBytes > self.maxBytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.numBytes -= evicted.nbytes
+
+    def Get(self, key:tuple) -> np.ndarray:
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return self.frames[key]
+
+        frame = self.Render(key)
+        self.Store(key, frame)
+        return frame
+
+    def Prefetch(self, keys:list):
+        # Queue renders for keys not cached yet, dropping queued renders that are no longer wanted
+        with self.lock:
+            for key in list(self.pending):
+                if key not in keys and self.pending[key].cancel():
+                    del self.pending[key]
+
+            for key in keys:
+                if key not in self.frames and key not in self.pending:
+                    self.pending[key] = self.executor.submit(self.PrefetchFrame, key)
+
+    def PrefetchFrame(self, key:tuple):
+        try:
+            with self.lock:
+                cached = key in self.frames
+            if not cached:
+                self.Store(key, self.Render(key))
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def Shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Class used to step through a list of images counted with the same settings, preparing the next image while the current one is counted
+class ImageQueue:
+    def __init__(self):
+        self.paths = []
+        self.index = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.nextImage = None # (path, future of the prepared image)
+        self.skipped = [] # (path, reason) of queued images that could not be decoded
+
+    def SetPaths(self, paths:list):
+        if self.nextImage is not None:
+            self.nextImage[1].cancel()
+        self.paths = list(paths)
+        self.index = 0
+        self.nextImage = None
+        self.skipped = []
+
+    def IsActive(self) -> bool:
+        return len(self.paths) > 0
+
+    def GetCurrentPath(self) -> str:
+        return self.paths[self.index]
+
+    def HasNext(self) -> bool:
+        return self.index + 1 < len(self.paths)
+
+    def Prefetch(self, prepare, *args):
+        # prepare(path, *args) runs on the background thread for the image after the current one
+        if not self.HasNext():
+            return
+        path = self.paths[self.index + 1]
+        if self.nextImage is not None and self.nextImage[0] == path:
+            return
+        self.nextImage = (path, self.executor.submit(prepare, path, *args))
+
+    def Advance(self) -> tuple:
+        # Path of the next image and the future of its preparation, None if it was never prefetched
+        self.index += 1
+        path = self.paths[self.index]
+        future = self.nextImage[1] if self.nextImage is not None and self.nextImage[0] == path else None
+        self.nextImage = None
+        return path, future
+
+    def Shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Class used to keep every completed measurement, its strata and its individual points in an indexed SQLite database
+class ResultsStore:
+    measurementColumns = ["id", "image_name", "image_path", "operator", "created_at", "count_area_type", "count_area_bounds", "num_strata", "confidence", "moe", "neff", "area_fraction", "lower_cl", "upper_cl", "num_points", "allocation", "phase"]
+    pointColumns = ["measurement_id", "point_index", "stratum", "row", "col", "value"]
+
+    def __init__(self, dbPath:str="RAFTResults.db"):
+        self.dbPath = dbPath
+        self.connection = sqlite3.connect(dbPath)
+        self.connection.execute("PRAGMA journal_mode=WAL") # readers do not block the writer
+        self.connection.execute("PRAGMA foreign_keys=ON") # off by default in SQLite, deleting a measurement cascades to its strata and points
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS measurements (
+                id INTEGER PRIMARY KEY,
+                image_name TEXT NOT NULL,
+                image_path TEXT,
+                operator TEXT,
+                created_at TEXT NOT NULL,
+                count_area_type TEXT,
+                count_area_bounds TEXT,
+                num_strata INTEGER,
+                confidence REAL,
+                moe REAL,
+                neff REAL,
+                area_fraction REAL,
+                lower_cl REAL,
+                upper_cl REAL,
+                num_points INTEGER,
+                allocation TEXT,
+                phase TEXT
+            );
+            CREATE TABLE IF NOT EXISTS strata (
+                measurement_id INTEGER NOT NULL REFERENCES measurements(id) ON DELETE CASCADE,
+                stratum INTEGER NOT NULL,
+                pixel_count INTEGER,
+                weight REAL,
+                initial_guess REAL,
+                num_samples INTEGER,
+                area_fraction REAL,
+                PRIMARY KEY (measurement_id, stratum)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS points (
+                measurement_id INTEGER NOT NULL REFERENCES measurements(id) ON DELETE CASCADE,
+                point_index INTEGER NOT NULL,
+                stratum INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                col INTEGER NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (measurement_id, point_index)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS measurements_image ON measurements(image_name, created_at);
+            CREATE INDEX IF NOT EXISTS measurements_date ON measurements(created_at);
+            CREATE INDEX IF NOT EXISTS measurements_operator ON measurements(operator, created_at);
+        """)
+        self.connection.commit()
+
+    def AddMeasurement(self, measurement:dict, strata:dict, points:dict) -> int:
+        # measurement holds the measurementColumns except id and created_at, strata and points hold one equal length array per column
+        with self.connection:
+            cursor = self.connection.execute(
+                f"INSERT INTO measurements ({', '.join(self.measurementColumns[1:])}) VALUES ({', '.join('?' * (len(self.measurementColumns) - 1))})",
+                [measurement.get(column) if column != "created_at" else datetime.now(timezone.utc).isoformat(timespec="seconds") for column in self.measurementColumns[1:]])
+            measurementId = cursor.lastrowid
+
+            self.connection.executemany("INSERT INTO strata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((measurementId, i, int(strata["pixel_count"][i]), float(strata["weight"][i]), float(strata["initial_guess"][i]), int(strata["num_samples"][i]), float(strata["area_fraction"][i])) for i in range(len(strata["weight"]))))
+            self.connection.executemany("INSERT INTO points VALUES (?, ?, ?, ?, ?, ?)",
+                ((measurementId, i, int(points["stratum"][i]), int(points["row"][i]), int(points["col"][i]), float(points["value"][i])) for i in range(len(points["value"]))))
+
+        return measurementId
+
+    def GetFilter(self, prefix:str="", imageName=None, operator=None, since=None, until=None, measurementIds=None) -> tuple:
+        # WHERE clause and parameters shared by queries and exports, dates are ISO strings compared lexically
+        clauses, parameters = [], []
+        if imageName is not None:
+            clauses.append(f"{prefix}image_name = ?")
+            parameters.append(imageName)
+        if operator is not None:
+            clauses.append(f"{prefix}operator = ?")
+            parameters.append(operator)
+        if since is not None:
+            clauses.append(f"{prefix}created_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            clauses.append(f"{prefix}created_at < ?")
+            parameters.append(until)
+        if measurementIds is not None:
+            clauses.append(f"{prefix}id IN ({', '.join('?' * len(measurementIds))})")
+            parameters += list(measurementIds)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+    def QueryMeasurements(self, **filters) -> list:
+        where, parameters = self.GetFilter(**filters)
+        return self.connection.execute(f"SELECT {', '.join(self.measurementColumns)} FROM measurements{where} ORDER BY created_at, id", parameters).fetchall()
+
+    def ExportMeasurementsCsv(self, outputPath:str, **filters) -> int:
+        # One row per measurement with each stratum's area fraction appended
+        where, parameters = self.GetFilter("m.", **filters)
+        cursor = self.connection.execute(
+            f"SELECT {', '.join('m.' + column for column in self.measurementColumns)}, (SELECT group_concat(area_fraction, ';') FROM (SELECT area_fraction FROM strata WHERE measurement_id = m.id ORDER BY stratum)) FROM measurements m{where} ORDER BY m.created_at, m.id", parameters)
+        numRows = 0
+        with open(outputPath, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(self.measurementColumns + ["strata_area_fractions"])
+            for row in cursor:
+                writer.writerow(row)
+                numRows += 1
+        return numRows
+
+    def ExportPointsCsv(self, outputPath:str, **filters) -> int:
+        where, parameters = self.GetFilter("m.", **filters)
+        cursor = self.connection.execute(
+            f"SELECT m.image_name, {', '.join('p.' + column for column in self.pointColumns)} FROM points p JOIN measurements m ON m.id = p.measurement_id{where} ORDER BY p.measurement_id, p.point_index", parameters)
+        numRows = 0
+        with open(outputPath, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["image_name"] + self.pointColumns)
+            for row in cursor:
+                writer.writerow(row)
+                numRows += 1
+        return numRows
+
+    def Close(self):
+        self.connection.close()
+
+
+# Class used to journal a counting session so it can be resumed after a crash
+# The first line is a JSON header with the configuration and sample plan, then one short line per recorded key
+class SessionJournal:
+    def __init__(self, journalPath:str="RAFTSession.journal", syncEvery:int=16, syncSeconds:float=2.0):
+        self.journalPath = journalPath
+        self.syncEvery = syncEvery # entries written between fsyncs
+        self.syncSeconds = syncSeconds # longest time an entry waits for an fsync
+        self.file = None
+        self.numUnsynced = 0
+        self.lastSync = time.monotonic()
+
+    def Start(self, header:dict):
+        self.Close()
+        self.file = open(self.journalPath, "w")
+        self.file.write(json.dumps(header, separators=(",", ":")) + "\n")
+        self.Sync()
+
+    def Resume(self):
+        self.Close()
+        self.file = open(self.journalPath, "a")
+
+    def Append(self, classIndex:int):
+        self.Write(f"{classIndex}\n")
+
+    def AppendEntry(self, entry:dict):
+        # Entries other than recorded values are written as one JSON line
+        self.Write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def Write(self, line:str):
+        if self.file is None:
+            return
+        # Every entry reaches the OS straight away, which survives the app crashing, fsync is batched for power loss
+        self.file.write(line)
+        self.file.flush()
+        self.numUnsynced += 1
+        if self.numUnsynced >= self.syncEvery or time.monotonic() - self.lastSync > self.syncSeconds:
+            self.Sync()
+
+    def Sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.numUnsynced = 0
+        self.lastSync = time.monotonic()
+
+    def Close(self):
+        if self.file is not None:
+            self.Sync()
+            self.file.close()
+            self.file = None
+
+    def Finish(self):
+        self.Close()
+        if os.path.exists(self.journalPath):
+            os.remove(self.journalPath)
+
+    def Load(self):
+        # (header, recorded classes and JSON entries) of an unfinished session, or None
+        if not os.path.isfile(self.journalPath):
+            return None
+        with open(self.journalPath) as file:
+            lines = file.read().split("\n")
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return None
+        if not isinstance(header, dict) or "phaseNames" not in header: # written by a version that journaled values instead of classes
+            return None
+
+        # Only newline terminated entries are complete, a torn final line is dropped
+        values = []
+        for line in lines[1:-1]:
+            try:
+                values.append(json.loads(line) if line.startswith("{") else int(line))
+            except ValueError:
+                break
+        return header, values
+
+
+# Class used to split the sample plan of one image between several operators counting it at the same time
+# Clients connect over TCP and exchange one JSON object per line, the coordinator hands out disjoint chunks of points and merges the classes sent back
+class CountingCoordinator:
+    def __init__(self, plan:dict, numClasses:int, token:str, address:tuple=("127.0.0.1", 5577), chunkSize:int=25):
+        self.plan = plan # journal header of the session, sent to every client
+        self.token = token # clients must send it in their hello, so a coordinator listening on 0.0.0.0 does not hand the plan to anyone
+        self.numClasses = numClasses
+        self.chunkSize = chunkSize
+        self.pointStrata = np.array(plan["strata"], dtype=np.int64)
+        self.pointClasses = np.full(len(self.pointStrata), -1, dtype=np.int8) # merged class of every point, -1 until it is counted
+        self.pointOwners = np.full(len(self.pointStrata), -1, dtype=np.int32) # client holding every point, -1 while it waits in the pool
+        self.stratumCounts = np.zeros(len(plan["n_h"]), dtype=np.int64)
+        self.stratumClassCounts = np.zeros((len(plan["n_h"]), numClasses), dtype=np.int64)
+        self.pool = deque(ConstituentCountingWidget.GetInterleavedOrder(self.pointStrata).tolist()) # every chunk advances all strata, so the merged estimate stays balanced
+        self.operators = {} # client id -> operator name
+        self.nextClientId = 0
+        self.lock = threading.Lock()
+
+        self.server = socketserver.ThreadingTCPServer(address, CountingRequestHandler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except OSError:
+            self.server.server_close()
+            raise
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def ParseAddress(text:str, defaultPort:int=5577) -> tuple:
+        # "host:port", "host" or ":port", the host defaults to this machine
+        host, _, port = text.strip().partition(":")
+        return host or "127.0.0.1", int(port) if port else defaultPort
+
+    def CheckToken(self, token) -> bool:
+        return isinstance(token, str) and secrets.compare_digest(token.encode(), self.token.encode())
+
+    def Connect(self, operator:str) -> int:
+        with self.lock:
+            clientId = self.nextClientId
+            self.nextClientId += 1
+            self.operators[clientId] = operator
+        print(f"{operator} joined the shared count")
+        return clientId
+
+    def RequestChunk(self, clientId:int) -> tuple:
+        # ("chunk", point indices), ("wait", []) while other clients hold every uncounted point, or ("done", []) once all are counted
+        with self.lock:
+            chunk = []
+            while len(self.pool) > 0 and len(chunk) < self.chunkSize:
+                index = self.pool.popleft()
+                if self.pointOwners[index] == -1 and self.pointClasses[index] == -1:
+                    chunk.append(index)
+            self.pointOwners[chunk] = clientId
+            if len(chunk) > 0:
+                return "chunk", chunk
+            return ("done", []) if np.all(self.pointClasses != -1) else ("wait", [])
+
+    def Label(self, clientId:int, index:int, classIndex:int):
+        # classIndex -1 takes back the class of a point, only the client holding a point may change it
+        if not 0 <= index < len(self.pointClasses) or not -1 <= classIndex < self.numClasses:
+            return
+        with self.lock:
+            if self.pointOwners[index] != clientId:
+                return
+            stratum = self.pointStrata[index]
+            if self.pointClasses[index] != -1:
+                self.stratumCounts[stratum] -= 1
+                self.stratumClassCounts[stratum, self.pointClasses[index]] -= 1
+            if classIndex != -1:
+                self.stratumCounts[stratum] += 1
+                self.stratumClassCounts[stratum, classIndex] += 1
+            self.pointClasses[index] = classIndex
+
+    def Disconnect(self, clientId:int):
+        # Points the client was given but never counted go back to the front of the pool for the next request
+        with self.lock:
+            returned = np.flatnonzero((self.pointOwners == clientId) & (self.pointClasses == -1))
+            self.pointOwners[returned] = -1
+            self.pool.extendleft(returned[::-1].tolist())
+            operator = self.operators.pop(clientId, None)
+        print(f"{operator} left the shared count, {len(returned)} uncounted points returned")
+
+    def GetCounts(self) -> tuple:
+        # Merged stratum counts, stratum class counts and number of counted points
+        with self.lock:
+            return self.stratumCounts.copy(), self.stratumClassCounts.copy(), int(np.sum(self.stratumCounts))
+
+    def GetClasses(self) -> np.ndarray:
+        with self.lock:
+            return self.pointClasses.copy()
+
+    def Shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Class used to serve one client of a CountingCoordinator, every line read is a JSON request
+class CountingRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        coordinator = self.server.coordinator
+        clientId = None
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if message["type"] == "hello" and clientId is None:
+                    if not coordinator.CheckToken(message.get("token")):
+                        self.Send({"type": "error", "message": "wrong share token"})
+                        print(f"Refused a shared counting client from {self.client_address[0]}, wrong share token")
+                        return
+                    clientId = coordinator.Connect(str(message.get("operator")))
+                    self.Send({"type": "plan", "plan": coordinator.plan})
+                elif message["type"] == "request" and clientId is not None:
+                    status, indices = coordinator.RequestChunk(clientId)
+                    self.Send({"type": status, "indices": indices})
+                elif message["type"] == "label" and clientId is not None:
+                    coordinator.Label(clientId, int(message["index"]), int(message["class"]))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Dropped a shared counting client: {e}")
+        finally:
+            if clientId is not None:
+                coordinator.Disconnect(clientId)
+
+    def Send(self, message:dict):
+        self.wfile.write((json.dumps(message, separators=(",", ":")) + "\n").encode())
+
+
+# Class used by the operator of the coordinating instance to count chunks without going through a socket
+class LocalCountingClient:
+    def __init__(self, coordinator:CountingCoordinator, operator:str):
+        self.coordinator = coordinator
+        self.plan = coordinator.plan
+        self.clientId = coordinator.Connect(operator)
+
+    def RequestChunk(self) -> tuple:
+        return self.coordinator.RequestChunk(self.clientId)
+
+    def Label(self, index:int, classIndex:int):
+        self.coordinator.Label(self.clientId, index, classIndex)
+
+    def Close(self):
+        self.coordinator.Disconnect(self.clientId)
+
+
+# Class used to count chunks handed out by the CountingCoordinator of another RAFT instance
+class CountingClient:
+    def __init__(self, host:str, port:int, operator:str, token:str, timeout:float=10.0):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.socket.makefile("rb")
+        try:
+            self.Send({"type": "hello", "operator": operator, "token": token})
+            reply = self.Receive()
+            if reply["type"] == "error":
+                raise ConnectionRefusedError(f"the coordinator refused to connect, {reply['message']}")
+            self.plan = reply["plan"]
+        except (OSError, ValueError, KeyError):
+            self.Close()
+            raise
+
+    def Send(self, message:dict):
+        self.socket.sendall((json.dumps(message, separators=(",", ":")) + "\n").encode())
+
+    def Receive(self) -> dict:
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("the coordinator closed the connection")
+        return json.loads(line)
+
+    def RequestChunk(self) -> tuple:
+        # Labels are sent without a reply, so the next line read is the answer to this request
+        self.Send({"type": "request"})
+        reply = self.Receive()
+        return reply["type"], reply["indices"]
+
+    def Label(self, index:int, classIndex:int):
+        self.Send({"type": "label", "index": int(index), "class": int(classIndex)})
+
+    def Close(self):
+        self.reader.close()
+        self.socket.close()
+
+
 class MplCanvas(FigureCanvasQTAgg):
 
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -85,6 +1277,211 @@ class MplCanvas(FigureCanvasQTAgg):
         self.axes = fig.add_subplot(111)
         super(MplCanvas, self).__init__(fig)
 
+        self.axes.set_yticks([])
+        self.axes.set_xticks([])
+        self.imageArtist = None
+
+    # Display an image through a single persistent AxesImage
+    # Same sized images only update the pixel data and blit the axes, a full draw happens only when the shape changes
+    def ShowImage(self, image:np.ndarray, cmap=None):
+        startTime = profiler.Now()
+        if self.imageArtist is None:
+            self.imageArtist = self.axes.imshow(image, cmap=cmap)
+            self.draw()
+            profiler.Record("draw", startTime)
+            return
+
+        previousShape = self.imageArtist.get_array().shape
+        self.imageArtist.set_data(image)
+        if image.ndim == 2:
+            self.imageArtist.set_clim(np.min(image), np.max(image))
+
+        if previousShape[:2] != image.shape[:2]:
+            self.imageArtist.set_extent((-0.5, image.shape[1]-0.5, image.shape[0]-0.5, -0.5))
+            self.draw()
+            profiler.Record("draw", startTime)
+            return
+
+        self.axes.draw_artist(self.imageArtist)
+        for spine in self.axes.spines.values():
+            self.axes.draw_artist(spine)
+        self.blit(self.axes.bbox)
+        profiler.Record("draw", startTime)
+
+
+# Class used to select a rectangular, circular, annular or polygon count area over a cached preview of the image
+# Only mouse and key events repaint, the preview is scaled once per resize and the outline is drawn over it
+class RoiSelector(QtWidgets.QDialog):
+    instructions = {
+        "Rectangular": "Drag a rectangle",
+        "Circular": "Click the center, then a point on the edge",
+        "Annular": "Click the center, then a point on the inner edge and one on the outer edge",
+        "Polygon": "Click the vertices, Backspace removes the last one",
+    }
+
+    def __init__(self, pyramid:list, imageShape:tuple, countAreaType:str, polarLayout:tuple=(1, 16), parent=None):
+        super(RoiSelector, self).__init__(parent)
+
+        self.pyramid = pyramid # previews from largest to smallest
+        self.imageRows, self.imageCols = imageShape[:2]
+        self.countAreaType = countAreaType
+        self.numRings, self.numSectors = polarLayout
+        self.numRadii = {"Circular": 1, "Annular": 2}.get(countAreaType, 0)
+
+        self.points = [] # clicked points in image pixels, the corners, the center or the vertices
+        self.radii = [] # accepted radii in image pixels
+        self.cursor = None # mouse position in image pixels, the open end of the outline follows it
+        self.message = ""
+
+        self.pixmap = None
+        self.scale = 1.0 # display pixels per image pixel
+        self.offset = QtCore.QPointF(0, 0)
+
+        self.setWindowTitle(f"Select {countAreaType} Count Area")
+        self.setMouseTracking(True)
+        screen = QtWidgets.QApplication.primaryScreen().availableSize()
+        fit = min(0.9 * screen.width() / self.imageCols, 0.9 * screen.height() / self.imageRows, 1.0)
+        self.resize(max(int(self.imageCols * fit), 400), max(int(self.imageRows * fit), 300))
+
+    def resizeEvent(self, event):
+        # The smallest pyramid level that covers the window is scaled here once, repaints only copy the pixmap
+        self.scale = min(self.width() / self.imageCols, self.height() / self.imageRows)
+        displayWidth, displayHeight = max(1, int(self.imageCols * self.scale)), max(1, int(self.imageRows * self.scale))
+        level = next((level for level in reversed(self.pyramid) if level.shape[1] >= displayWidth), self.pyramid[0])
+        image = QtGui.QImage(level.data, level.shape[1], level.shape[0], level.strides[0], QtGui.QImage.Format_RGB888)
+        self.pixmap = QtGui.QPixmap.fromImage(image).scaled(displayWidth, displayHeight, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        self.offset = QtCore.QPointF((self.width() - displayWidth) / 2, (self.height() - displayHeight) / 2)
+        super(RoiSelector, self).resizeEvent(event)
+
+    def ToImage(self, position) -> tuple:
+        x = int((position.x() - self.offset.x()) / self.scale)
+        y = int((position.y() - self.offset.y()) / self.scale)
+        return min(max(x, 0), self.imageCols - 1), min(max(y, 0), self.imageRows - 1)
+
+    def ToDisplay(self, x, y) -> QtCore.QPointF:
+        return QtCore.QPointF(self.offset.x() + x * self.scale, self.offset.y() + y * self.scale)
+
+    def GetRadius(self, point:tuple) -> int:
+        return int(np.sqrt((point[0] - self.points[0][0]) ** 2 + (point[1] - self.points[0][1]) ** 2))
+
+    def GetRadiusError(self, radius:int) -> str:
+        centerX, centerY = self.points[0]
+        if centerX - radius < 0 or centerY - radius < 0 or centerX + radius > self.imageCols or centerY + radius > self.imageRows:
+            return "Circle extends beyond image bounds."
+        if len(self.radii) > 0 and radius <= self.radii[0]:
+            return "The outer edge must lie outside the inner edge."
+        return ""
+
+    def mousePressEvent(self, event):
+        if event.button() == QtCore.Qt.LeftButton and self.countAreaType == "Rectangular":
+            self.points = [self.ToImage(event.pos())]
+            self.cursor = self.points[0]
+            self.update()
+
+    def mouseMoveEvent(self, event):
+        self.cursor = self.ToImage(event.pos())
+        if len(self.points) > 0: # nothing follows the cursor before the first click
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() != QtCore.Qt.LeftButton:
+            return
+        point = self.ToImage(event.pos())
+        self.message = ""
+        if self.countAreaType == "Rectangular":
+            self.points = self.points[:1] + [point]
+        elif self.countAreaType == "Polygon":
+            self.points.append(point)
+        elif len(self.points) == 0:
+            self.points = [point]
+        elif len(self.radii) < self.numRadii:
+            radius = self.GetRadius(point)
+            self.message = self.GetRadiusError(radius)
+            if self.message == "":
+                self.radii.append(radius)
+        self.update()
+
+    def keyPressEvent(self, event):
+        if event.key() in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter, QtCore.Qt.Key_Q):
+            self.accept()
+        elif event.key() == QtCore.Qt.Key_Backspace:
+            if len(self.radii) > 0:
+                self.radii.pop()
+            elif len(self.points) > 0:
+                self.points.pop()
+            self.message = ""
+            self.update()
+        else:
+            super(RoiSelector, self).keyPressEvent(event) # Escape cancels
+
+    def GetBounds(self):
+        # x, y, width, height (rectangular), center x, center y and radii (circular, annular) or x0, y0, x1, y1, ... (polygon), None while incomplete
+        if self.countAreaType == "Rectangular":
+            if len(self.points) < 2:
+                return None
+            (x0, y0), (x1, y1) = self.points
+            if x0 == x1 or y0 == y1:
+                return None
+            return [min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0)]
+        if self.countAreaType == "Polygon":
+            return [coordinate for vertex in self.points for coordinate in vertex] if len(self.points) >= 3 else None
+        if len(self.radii) < self.numRadii:
+            return None
+        return [*self.points[0], *self.radii]
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtCore.Qt.black)
+        painter.drawPixmap(self.offset, self.pixmap)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        pen = QtGui.QPen(QtGui.QColor(255, 0, 0), 2)
+        painter.setPen(pen)
+
+        if self.countAreaType == "Rectangular" and len(self.points) > 0:
+            corner = self.points[1] if len(self.points) > 1 else self.cursor
+            painter.drawRect(QtCore.QRectF(self.ToDisplay(*self.points[0]), self.ToDisplay(*corner)))
+        elif self.countAreaType == "Polygon" and len(self.points) > 0:
+            vertices = [self.ToDisplay(*point) for point in self.points]
+            painter.drawPolyline(QtGui.QPolygonF(vertices + ([self.ToDisplay(*self.cursor)] if self.cursor is not None else [])))
+            if len(vertices) >= 2: # closing edge
+                pen.setStyle(QtCore.Qt.DashLine)
+                painter.setPen(pen)
+                painter.drawLine(vertices[0], self.ToDisplay(*self.cursor) if self.cursor is not None else vertices[-1])
+            for vertex in vertices:
+                painter.drawEllipse(vertex, 3, 3)
+        elif len(self.points) > 0:
+            painter.drawEllipse(self.ToDisplay(*self.points[0]), 3, 3)
+            radii = list(self.radii)
+            if len(radii) < self.numRadii and self.cursor is not None:
+                # The radius under the cursor is drawn in yellow while it cannot be accepted
+                radii.append(self.GetRadius(self.cursor))
+                if self.GetRadiusError(radii[-1]) != "":
+                    pen.setColor(QtGui.QColor(255, 255, 0))
+                    painter.setPen(pen)
+            self.DrawPolarStrata(painter, radii)
+
+        # Instructions, or why the last click was not accepted
+        text = self.message or f"{self.instructions[self.countAreaType]}. Enter to accept, Escape to cancel"
+        painter.fillRect(QtCore.QRectF(0, 0, self.width(), 24), QtGui.QColor(0, 0, 0, 160))
+        painter.setPen(QtGui.QColor(255, 255, 255))
+        painter.drawText(QtCore.QRectF(6, 0, self.width() - 12, 24), QtCore.Qt.AlignVCenter, text)
+
+    def DrawPolarStrata(self, painter, radii:list):
+        # Ring edges split the area equally like the StrataMap, spokes split the rings into sectors
+        center = self.ToDisplay(*self.points[0])
+        if len(radii) < self.numRadii:
+            for radius in radii:
+                painter.drawEllipse(center, radius * self.scale, radius * self.scale)
+            return
+
+        innerRadius, outerRadius = (0, radii[0]) if self.countAreaType == "Circular" else radii
+        ringRadii = np.sqrt(innerRadius**2 + np.arange(self.numRings+1) / self.numRings * (outerRadius**2 - innerRadius**2)) * self.scale
+        for radius in ringRadii[ringRadii > 0]:
+            painter.drawEllipse(center, radius, radius)
+        for theta in np.linspace(0, 2 * np.pi, self.numSectors + 1)[:-1]:
+            direction = QtCore.QPointF(np.cos(theta), np.sin(theta))
+            painter.drawLine(center + direction * ringRadii[0], center + direction * ringRadii[-1])
+
 
 class SetupWidget(QtWidgets.QWidget):
     def __init__(self, parentTab):
@@ -92,6 +1489,7 @@ class SetupWidget(QtWidgets.QWidget):
 
         self.parentTab = parentTab
         self.countAreaBounds = None
+        self.measurementIds = [] # results store ids of the measurements made this session
 
         # Step 1 widgets and layout
         self.step1Number = QtWidgets.QLabel("1")
@@ -99,12 +1497,21 @@ class SetupWidget(QtWidgets.QWidget):
         self.selectImageText = QtWidgets.QLabel("Select Image:")
         self.imagePathBox = QtWidgets.QLineEdit("")
         self.browseImagePath = QtWidgets.QPushButton("Browse")
+        self.browseImagePath.setToolTip("Select one image, or several to count them one after another with the same settings")
+        self.queueFolderButton = QtWidgets.QPushButton("Queue Folder")
+        self.queueFolderButton.setToolTip("Count every image in a folder one after another with the same settings")
+        self.queueText = QtWidgets.QLabel("")
+        self.joinSharedButton = QtWidgets.QPushButton("Join Shared Count")
+        self.joinSharedButton.setToolTip("Count part of a measurement shared by another RAFT instance")
 
         step1layout = QtWidgets.QHBoxLayout()
         step1layout.addWidget(self.step1Number)
         step1layout.addWidget(self.selectImageText)
         step1layout.addWidget(self.imagePathBox, stretch=2)
         step1layout.addWidget(self.browseImagePath)
+        step1layout.addWidget(self.queueFolderButton)
+        step1layout.addWidget(self.queueText)
+        step1layout.addWidget(self.joinSharedButton)
 
         self.step1Widget = QtWidgets.QWidget()
         self.step1Widget.setLayout(step1layout)
@@ -121,11 +1528,14 @@ class SetupWidget(QtWidgets.QWidget):
         self.selectCircCropButton.setCheckable(True)
         self.selectAnnularCropButton = QtWidgets.QPushButton("Annular Crop")
         self.selectAnnularCropButton.setCheckable(True)
+        self.selectPolygonCropButton = QtWidgets.QPushButton("Polygon Crop")
+        self.selectPolygonCropButton.setCheckable(True)
         
         self.selectFullImageButton.setDisabled(True)
         self.selectRectCropButton.setDisabled(True)
         self.selectCircCropButton.setDisabled(True)
         self.selectAnnularCropButton.setDisabled(True)
+        self.selectPolygonCropButton.setDisabled(True)
 
         step2layout = QtWidgets.QHBoxLayout()
         step2layout.addWidget(self.step2Number)
@@ -134,6 +1544,7 @@ class SetupWidget(QtWidgets.QWidget):
         step2layout.addWidget(self.selectRectCropButton,stretch=2)
         step2layout.addWidget(self.selectCircCropButton,stretch=2)
         step2layout.addWidget(self.selectAnnularCropButton,stretch=2)
+        step2layout.addWidget(self.selectPolygonCropButton,stretch=2)
 
         self.step2Widget = QtWidgets.QWidget()
         self.step2Widget.setLayout(step2layout)
@@ -145,6 +1556,21 @@ class SetupWidget(QtWidgets.QWidget):
         self.setCIbox = QtWidgets.QLineEdit("")
         self.setMOEtext = QtWidgets.QLabel("Set MOE:")
         self.setMOEbox = QtWidgets.QLineEdit("")
+        self.setStrataText = QtWidgets.QLabel("Strata:")
+        self.setStrataBox = QtWidgets.QLineEdit("")
+        self.setStrataBox.setPlaceholderText("16")
+        self.setStrataBox.setToolTip("Number of strata, or rows x columns (rings x sectors for circular and annular areas), e.g. 16 or 4x8. Polygon areas drop the grid cells outside the polygon")
+        self.setPhasesText = QtWidgets.QLabel("Phases:")
+        self.setPhasesBox = QtWidgets.QLineEdit("")
+        self.setPhasesBox.setPlaceholderText("Single")
+        self.setPhasesBox.setToolTip("Leave blank to count one phase with the arrow keys, or name two or more phases counted in one pass with number keys, e.g. Pore, Carbide, Matrix or Pore:7, Matrix:9. Initial guesses are for the first phase")
+        self.setAllocationText = QtWidgets.QLabel("Allocation:")
+        self.setAllocationBox = QtWidgets.QComboBox()
+        self.setAllocationBox.addItems(["Equal", "Neyman", "Two-Phase"])
+        self.stopEarlyBox = QtWidgets.QCheckBox("Stop Early")
+        self.stopEarlyBox.setToolTip("End the measurement as soon as the live CI meets the MOE")
+        self.shareBox = QtWidgets.QCheckBox("Share")
+        self.shareBox.setToolTip("Let other RAFT instances join the count and split its points, without early stopping or a second phase")
 
         step3layout = QtWidgets.QHBoxLayout()
         step3layout.addWidget(self.step3Number)
@@ -152,6 +1578,14 @@ class SetupWidget(QtWidgets.QWidget):
         step3layout.addWidget(self.setCIbox)
         step3layout.addWidget(self.setMOEtext)
         step3layout.addWidget(self.setMOEbox)
+        step3layout.addWidget(self.setStrataText)
+        step3layout.addWidget(self.setStrataBox)
+        step3layout.addWidget(self.setPhasesText)
+        step3layout.addWidget(self.setPhasesBox)
+        step3layout.addWidget(self.setAllocationText)
+        step3layout.addWidget(self.setAllocationBox)
+        step3layout.addWidget(self.stopEarlyBox)
+        step3layout.addWidget(self.shareBox)
 
         self.step3Widget = QtWidgets.QWidget()
         self.step3Widget.setLayout(step3layout)
@@ -203,10 +1637,13 @@ class SetupWidget(QtWidgets.QWidget):
         # Connect triggers
         self.imagePathBox.textChanged.connect(self.CheckImagePath)
         self.browseImagePath.clicked.connect(self.BrowseForImage)
+        self.queueFolderButton.clicked.connect(self.BrowseForFolder)
+        self.joinSharedButton.clicked.connect(self.JoinSharedCount)
         self.selectFullImageButton.clicked.connect(self.SelectFullImage)
         self.selectRectCropButton.clicked.connect(self.RectangularCrop)
         self.selectCircCropButton.clicked.connect(self.CircularCrop)
         self.selectAnnularCropButton.clicked.connect(self.AnnularCrop)
+        self.selectPolygonCropButton.clicked.connect(self.PolygonCrop)
         self.beginMeasurementButton.clicked.connect(self.BeginMeasurement)
         self.setMOEbox.textChanged.connect(self.CheckMOEandCI)
         self.setCIbox.textChanged.connect(self.CheckMOEandCI)
@@ -217,6 +1654,7 @@ class SetupWidget(QtWidgets.QWidget):
         self.selectRectCropButton.setChecked(False)
         self.selectCircCropButton.setChecked(False)
         self.selectAnnularCropButton.setChecked(False)
+        self.selectPolygonCropButton.setChecked(False)
 
         self.countAreaBounds = None
         self.step2Number.setStyleSheet("border: 3px solid black; background-color: lightgreen; font: bold 24px")
@@ -226,223 +1664,79 @@ class SetupWidget(QtWidgets.QWidget):
         self.selectRectCropButton.setChecked(True)
         self.selectCircCropButton.setChecked(False)
         self.selectAnnularCropButton.setChecked(False)
+        self.selectPolygonCropButton.setChecked(False)
 
-        img = cv2.imread(self.imagePathBox.text())
-
-        screen = QtWidgets.QApplication.primaryScreen()
-        screen_size = screen.size()
-        max_width = int(screen_size.width() * 0.9)
-        max_height = int(screen_size.height() * 0.9)
-        
-        img_disp = img.copy()
-        h, w = img_disp.shape[:2]
-        scale = min(max_width / w, max_height / h, 1.0)
-        if scale < 1.0:
-            img_disp = cv2.resize(img_disp, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
-
-        # top left x, top left y, width, height
-        self.countAreaBounds = cv2.selectROI("Select a ROI and then press ENTER button", img_disp)
-        cv2.destroyWindow('Select a ROI and then press ENTER button')
-
-        if self.countAreaBounds[2] == 0 and self.countAreaBounds[3] == 0:
-            self.step2Number.setStyleSheet("border: 3px solid black; background-color; font: bold 24px")
-            self.selectRectCropButton.setChecked(False)
-        else:
-            self.countAreaBounds = [int(n/scale) for n in self.countAreaBounds]  # Convert to original image coordinates
-            self.step2Number.setStyleSheet("border: 3px solid black; background-color: lightgreen; font: bold 24px")
+        self.SelectCountArea("Rectangular", self.selectRectCropButton)
 
     def CircularCrop(self):
         self.selectFullImageButton.setChecked(False)
         self.selectRectCropButton.setChecked(False)
         self.selectCircCropButton.setChecked(True)
         self.selectAnnularCropButton.setChecked(False)
+        self.selectPolygonCropButton.setChecked(False)
 
-        coords = [None, None, None]
-        img = cv2.imread(self.imagePathBox.text())
-        lineThickness = 3 # Set line thickness based on image size
-
-        screen = QtWidgets.QApplication.primaryScreen()
-        screen_size = screen.size()
-        max_width = int(screen_size.width() * 0.9)
-        max_height = int(screen_size.height() * 0.9)
-        
-        img_disp = img.copy()
-        h, w = img_disp.shape[:2]
-        scale = min(max_width / w, max_height / h, 1.0)
-        if scale < 1.0:
-            img_disp = cv2.resize(img_disp, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
-
-        # mouse callback function
-        def draw_circle(event,x,y,flags,param):      
-            if event == cv2.EVENT_LBUTTONUP:
-                if param[0] is None:
-                    param[0] = int(x / scale)
-                    param[1] = int(y / scale)
-                    cv2.circle(img_disp, (x, y), 5, (0, 0, 255), -1)
-                elif param[2] is None:
-                    # Convert display coordinates to original image coordinates
-                    x_orig = int(x / scale)
-                    y_orig = int(y / scale)
-                    center_x_orig = param[0]
-                    center_y_orig = param[1]
-                    radius_orig = int(np.sqrt((center_x_orig - x_orig) ** 2 + (center_y_orig - y_orig) ** 2))
-                    radius_disp = int(radius_orig * scale)
-
-                    if center_x_orig + radius_orig > img.shape[1] or center_x_orig - radius_orig < 0:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText("Error")
-                        msg.setInformativeText('Circle extends beyond image bounds.')
-                        msg.setWindowTitle("Error")
-                        msg.exec_()
-                    elif center_y_orig + radius_orig > img.shape[0] or center_y_orig - radius_orig < 0:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText("Error")
-                        msg.setInformativeText('Circle extends beyond image bounds.')
-                        msg.setWindowTitle("Error")
-                        msg.exec_()
-
-                    else:
-                        param[2] = radius_orig
-                        cv2.circle(img_disp, (int(param[0]*scale), int(param[1]*scale)), radius_disp, (0, 0, 255), lineThickness)
-
-                        # find points along radius that divide circle into 16 strata
-                        thetas = np.linspace(0, 2 * np.pi, 17)
-                        for theta in thetas:
-                            endPointX_disp = int(param[0] + radius_disp * np.cos(theta))
-                            endPointY_disp = int(param[1] + radius_disp * np.sin(theta))
-                            cv2.line(img_disp, (param[0], param[1]), (endPointX_disp, endPointY_disp), (0, 0, 255), lineThickness)
-            
-        cv2.namedWindow('image')
-        cv2.setMouseCallback('image',draw_circle, param=coords)
-
-        while(1):
-            # Resize the image to fit the screen before displaying
-            cv2.imshow('image', img_disp)
-            k = cv2.waitKey(1) & 0xFF
-            if k == 10 or k == 13 or k == ord("q"):
-                break
-        cv2.destroyAllWindows()
-
-        if coords[0] is not None and coords[2] is not None:
-            self.countAreaBounds = coords
-            self.step2Number.setStyleSheet("border: 3px solid black; background-color: lightgreen; font: bold 24px")
-        else:
-            self.step2Number.setStyleSheet("border: 3px solid black; font: bold 24px")
-            self.selectCircCropButton.setChecked(False)
+        self.SelectCountArea("Circular", self.selectCircCropButton)
 
     def AnnularCrop(self):
         self.selectFullImageButton.setChecked(False)
         self.selectRectCropButton.setChecked(False)
         self.selectCircCropButton.setChecked(False)
         self.selectAnnularCropButton.setChecked(True)
+        self.selectPolygonCropButton.setChecked(False)
 
-        coords = [None, None, None, None]
-        img = cv2.imread(self.imagePathBox.text())
-        lineThickness = 3
+        self.SelectCountArea("Annular", self.selectAnnularCropButton)
 
-        screen = QtWidgets.QApplication.primaryScreen()
-        screen_size = screen.size()
-        max_width = int(screen_size.width() * 0.9)
-        max_height = int(screen_size.height() * 0.9)
-        
-        img_disp = img.copy()
-        h, w = img_disp.shape[:2]
-        scale = min(max_width / w, max_height / h, 1.0)
-        if scale < 1.0:
-            img_disp = cv2.resize(img_disp, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
-
-        # mouse callback function
-        def draw_circle(event,x,y,flags,param):      
-            if event == cv2.EVENT_LBUTTONUP:
-                if param[0] is None:
-                    param[0] = int(x/scale)
-                    param[1] = int(y/scale)
-                    cv2.circle(img_disp,(x,y), 5, (0,0,255), -1)
-                elif param[2] is None:
-                    x_orig = int(x / scale)
-                    y_orig = int(y / scale)
-                    center_x_orig = param[0]
-                    center_y_orig = param[1]
-                    radius_orig = int(np.sqrt((center_x_orig - x_orig) ** 2 + (center_y_orig - y_orig) ** 2))
-                    radius_disp = int(radius_orig * scale)
-                    if param[0] + radius_orig > img.shape[1] or param[0] - radius_orig < 0:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText("Error")
-                        msg.setInformativeText('Circle extends beyond image bounds.')
-                        msg.setWindowTitle("Error")
-                        msg.exec_()
-                    elif param[1] + radius_orig > img.shape[0] or param[1] - radius_orig < 0:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText("Error")
-                        msg.setInformativeText('Circle extends beyond image bounds.')
-                        msg.setWindowTitle("Error")
-                        msg.exec_()
-                    else:
-                        param[2] = radius_orig
-                        cv2.circle(img_disp, (int(param[0]*scale), int(param[1]*scale)), radius_disp, (0, 0, 255), lineThickness)
-                elif param[3] is None:
-                    x_orig = int(x / scale)
-                    y_orig = int(y / scale)
-                    center_x_orig = param[0]
-                    center_y_orig = param[1]
-                    radius_orig = int(np.sqrt((center_x_orig - x_orig) ** 2 + (center_y_orig - y_orig) ** 2))
-                    radius_disp = int(radius_orig * scale)
-                    if param[0] + radius_orig > img.shape[1] or param[0] - radius_orig < 0:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText("Error")
-                        msg.setInformativeText('Circle extends beyond image bounds.')
-                        msg.setWindowTitle("Error")
-                        msg.exec_()
-                    elif param[1] + radius_orig > img.shape[0] or param[1] - radius_orig < 0:
-                        msg = QtWidgets.QMessageBox()
-                        msg.setIcon(QtWidgets.QMessageBox.Critical)
-                        msg.setText("Error")
-                        msg.setInformativeText('Circle extends beyond image bounds.')
-                        msg.setWindowTitle("Error")
-                        msg.exec_()
-                    else:
-                        param[3] = radius_orig
-                        cv2.circle(img_disp, (int(param[0]*scale), int(param[1]*scale)), radius_disp, (0, 0, 255), lineThickness)
-
-                        # find points along radius that divide circle into 16 strata
-                        thetas = np.linspace(0,2*np.pi, 17)
-                        for theta in thetas:
-                            startPointX = int(param[2] * scale * np.cos(theta))
-                            startPointY = int(param[2] * scale * np.sin(theta))
-                            startPointX += int(param[0] * scale)
-                            startPointY += int(param[1] * scale)
-                            endPointX = int(param[3] * scale * np.cos(theta))
-                            endPointY = int(param[3] * scale * np.sin(theta))
-                            endPointX += int(param[0] * scale)
-                            endPointY += int(param[1] * scale)
-                            cv2.line(img_disp, (startPointX, startPointY), (endPointX, endPointY), (0, 0, 255), lineThickness)
-        
-        cv2.namedWindow('image')
-        cv2.setMouseCallback('image',draw_circle, param=coords)
+    def PolygonCrop(self):
+        self.selectFullImageButton.setChecked(False)
+        self.selectRectCropButton.setChecked(False)
+        self.selectCircCropButton.setChecked(False)
+        self.selectAnnularCropButton.setChecked(False)
+        self.selectPolygonCropButton.setChecked(True)
 
-        while(1):
-            cv2.imshow('image',img_disp)
-            k = cv2.waitKey(1) & 0xFF
-            if k == 10 or k == 13 or k == ord("q"):
-                break
-        cv2.destroyAllWindows()
+        self.SelectCountArea("Polygon", self.selectPolygonCropButton)
 
-        if coords[0] is not None and coords[2] is not None and coords[3] is not None:
-            self.step2Number.setStyleSheet("border: 3px solid black; background-color: lightgreen; font: bold 24px")
-            self.countAreaBounds = coords
-        else:
+    def SelectCountArea(self, countAreaType, button):
+        # Bounds in image pixels, unchanged and the button unchecked if the selection is cancelled or incomplete
+        imagePath = self.imagePathBox.text()
+        imageStore = self.parentTab.imageStore
+        selector = RoiSelector(imageStore.GetPyramid(imagePath), imageStore.GetImage(imagePath).shape, countAreaType, self.GetPolarLayout(countAreaType), self)
+        bounds = selector.GetBounds() if selector.exec_() == QtWidgets.QDialog.Accepted else None
+
+        if bounds is None:
             self.step2Number.setStyleSheet("border: 3px solid black; font: bold 24px")
-            self.selectAnnularCropButton.setChecked(False)
+            button.setChecked(False)
+        else:
+            self.countAreaBounds = bounds
+            self.step2Number.setStyleSheet("border: 3px solid black; background-color: lightgreen; font: bold 24px")
 
     def BrowseForImage(self):
-        fileName = QtWidgets.QFileDialog.getOpenFileName(self,'Select Image File','./')
-        if fileName is not None:
-            self.imagePathBox.setText(fileName[0])
+        fileNames = QtWidgets.QFileDialog.getOpenFileNames(self,'Select Image Files','./')
+        if fileNames is not None and len(fileNames[0]) > 0:
+            self.SetQueue(fileNames[0] if len(fileNames[0]) > 1 else [])
+            self.imagePathBox.setText(fileNames[0][0])
+
+    def BrowseForFolder(self):
+        directory = QtWidgets.QFileDialog.getExistingDirectory(self,'Select Image Folder','./')
+        if directory:
+            self.SetQueue(ListImages(directory))
+
+    def SetQueue(self, imagePaths:list):
+        # More than one image is counted as a queue, CI, MOE, count area and strata are kept from one image to the next
+        self.parentTab.imageQueue.SetPaths(imagePaths)
+        if len(imagePaths) == 0:
+            self.queueText.setText("")
+            return
+        self.queueText.setText(f"{len(imagePaths)} images queued")
+        self.imagePathBox.setText(imagePaths[0])
+
+    def JoinSharedCount(self):
+        host, port = self.parentTab.shareAddress
+        address, ok = QtWidgets.QInputDialog.getText(self, "Join Shared Count", "Coordinator address (host:port):", text=f"{host}:{port}")
+        if not ok:
+            return
+        token, ok = QtWidgets.QInputDialog.getText(self, "Join Shared Count", "Share token shown by the coordinating instance:")
+        if ok:
+            self.parentTab.JoinSharedCount(address, token.strip())
 
     def BeginMeasurement(self):
         c1 = self.step1Number.palette().button().color().name()
@@ -450,6 +1744,10 @@ class SetupWidget(QtWidgets.QWidget):
         c3 = self.step3Number.palette().button().color().name()
 
         if c1 == "#90ee90" and c2 == "#90ee90" and c3 == "#90ee90":
+            # A path typed over the first queued image counts that image alone
+            imageQueue = self.parentTab.imageQueue
+            if imageQueue.IsActive() and imageQueue.GetCurrentPath() != self.imagePathBox.text():
+                self.SetQueue([])
             self.parentTab.MoveToInitialGuessWidget()
         else:
             msg = QtWidgets.QMessageBox()
@@ -461,23 +1759,28 @@ class SetupWidget(QtWidgets.QWidget):
 
     def CheckImagePath(self):
         try:
-            io.imread(self.imagePathBox.text())
+            if not os.path.isfile(self.imagePathBox.text()):
+                raise FileNotFoundError(self.imagePathBox.text())
+            self.parentTab.imageStore.GetImage(self.imagePathBox.text())
             self.step1Number.setStyleSheet("border: 3px solid black; background-color: lightgreen; font: bold 24px")
             self.selectFullImageButton.setEnabled(True)
             self.selectRectCropButton.setEnabled(True)
             self.selectCircCropButton.setEnabled(True)
             self.selectAnnularCropButton.setEnabled(True)
+            self.selectPolygonCropButton.setEnabled(True)
         except:
             self.step1Number.setStyleSheet("border: 3px solid black; background-color: yellow; font: bold 24px")
             self.selectFullImageButton.setChecked(False)
             self.selectRectCropButton.setChecked(False)
             self.selectCircCropButton.setChecked(False)
             self.selectAnnularCropButton.setChecked(False)
+            self.selectPolygonCropButton.setChecked(False)
 
             self.selectFullImageButton.setDisabled(True)
             self.selectRectCropButton.setDisabled(True)
             self.selectCircCropButton.setDisabled(True)
             self.selectAnnularCropButton.setDisabled(True)
+            self.selectPolygonCropButton.setDisabled(True)
         
         self.step2Number.setStyleSheet("border: 3px solid black; font: bold 24px")
 
@@ -516,11 +1819,22 @@ class SetupWidget(QtWidgets.QWidget):
 
         return moe
 
-    def AddResultsToTable(self, p_st, lowerCL, upperCL):
+    def GetStrataLayout(self, countAreaType):
+        return StrataMap.ParseLayout(self.setStrataBox.text(), countAreaType)
+
+    def GetPolarLayout(self, countAreaType):
+        # Rings and sectors drawn while selecting a circular or annular area, the default split if the strata box is not valid yet
+        try:
+            return self.GetStrataLayout(countAreaType)[1]
+        except ValueError:
+            return StrataMap.GetDefaultLayout(16, countAreaType)
+
+    def AddResultsToTable(self, p_st, lowerCL, upperCL, phaseName=None):
         rowPosition = self.previousResultsTable.rowCount()
         self.previousResultsTable.insertRow(rowPosition)
         
-        self.previousResultsTable.setItem(rowPosition,0, QtWidgets.QTableWidgetItem(f"{os.path.basename(self.imagePathBox.text())}"))
+        imageName = os.path.basename(self.imagePathBox.text())
+        self.previousResultsTable.setItem(rowPosition,0, QtWidgets.QTableWidgetItem(imageName if phaseName is None else f"{imageName} ({phaseName})"))
         self.previousResultsTable.setItem(rowPosition,1, QtWidgets.QTableWidgetItem(f"{100*p_st:.2f}%"))
         self.previousResultsTable.setItem(rowPosition,2, QtWidgets.QTableWidgetItem(f"{int(self.GetConfidence()*100)}% CI: ({100*lowerCL:.1f}%, {100*upperCL:.1f}%)"))
         self.previousResultsTable.setItem(rowPosition,3, QtWidgets.QTableWidgetItem(f"{100*(upperCL-lowerCL)/2:.2f}%"))
@@ -539,11 +1853,13 @@ class SetupWidget(QtWidgets.QWidget):
         self.selectRectCropButton.setChecked(False)
         self.selectCircCropButton.setChecked(False)
         self.selectAnnularCropButton.setChecked(False)
+        self.selectPolygonCropButton.setChecked(False)
 
         self.selectFullImageButton.setDisabled(True)
         self.selectRectCropButton.setDisabled(True)
         self.selectCircCropButton.setDisabled(True)
         self.selectAnnularCropButton.setDisabled(True)
+        self.selectPolygonCropButton.setDisabled(True)
 
         self.countAreaBounds = None
 
@@ -551,22 +1867,23 @@ class SetupWidget(QtWidgets.QWidget):
         self.setMOEbox.setText("")
         self.setCIbox.setText("")
 
+        self.queueText.setText("")
+
     def WriteResultsToCsv(self):
-        if self.previousResultsTable.rowCount() == 1:
+        # Measurements of this session are read back from the results store rather than from the table text
+        if len(self.measurementIds) == 0:
             return
         else:
-            if os.path.exists("AreaFractionResults.csv"):
-                startRow = 1
-            else:
-                startRow = 0
+            writeHeader = not os.path.exists("AreaFractionResults.csv")
             with open("AreaFractionResults.csv", "a", newline="") as file:
                 writer = csv.writer(file)
-                for i in range(startRow, self.previousResultsTable.rowCount()):
-                    rowToWrite = []
-                    for j in range(4):
-                        rowToWrite.append(self.previousResultsTable.item(i, j).text())
-                    
-                    writer.writerow(rowToWrite)
+                if writeHeader:
+                    writer.writerow(["Image Name", "Area Fraction", "Confidence Interval", "Margin of Error"])
+                for row in self.parentTab.resultsStore.QueryMeasurements(measurementIds=self.measurementIds):
+                    measurement = dict(zip(ResultsStore.measurementColumns, row))
+                    p_st, lowerCL, upperCL = measurement["area_fraction"], measurement["lower_cl"], measurement["upper_cl"]
+                    imageName = measurement["image_name"] if measurement["phase"] is None else f"{measurement['image_name']} ({measurement['phase']})"
+                    writer.writerow([imageName, f"{100*p_st:.2f}%", f"{round(measurement['confidence']*100)}% CI: ({100*lowerCL:.1f}%, {100*upperCL:.1f}%)", f"{100*(upperCL-lowerCL)/2:.2f}%"])
 
 
 class InitialGuessWidget(QtWidgets.QWidget):
@@ -580,6 +1897,8 @@ class InitialGuessWidget(QtWidgets.QWidget):
         self.initialGuesses = []
 
         self.parentTab = parentTab
+        self.previews = [] # future of the downsampled view of each stratum
+        self.previewExecutor = ThreadPoolExecutor(max_workers=1)
         
         # 5, 12.5, 25, 37.5, 50, 62.5, 75, 87.5, 95
         self.fivePctButton = QtWidgets.QPushButton("5%")
@@ -615,203 +1934,176 @@ class InitialGuessWidget(QtWidgets.QWidget):
         self.buttonRegion = QtWidgets.QWidget()
         self.buttonRegion.setLayout(hbox)
 
+        # Automatic estimates from a threshold on a downsampled image, Otsu when no level is given
+        self.autoGuesses = None
+        self.thresholdText = QtWidgets.QLabel("Threshold:")
+        self.thresholdBox = QtWidgets.QLineEdit("")
+        self.thresholdBox.setPlaceholderText("Otsu")
+        self.thresholdBox.editingFinished.connect(self.EstimateGuesses)
+        self.phaseBox = QtWidgets.QComboBox()
+        self.phaseBox.addItems(["Dark Phase", "Bright Phase"])
+        self.phaseBox.currentIndexChanged.connect(self.EstimateGuesses)
+        self.autoEstimateText = QtWidgets.QLabel("Automatic Estimate: --")
+        self.autoEstimateText.setAlignment(QtCore.Qt.AlignCenter)
+        self.autoEstimateText.setStyleSheet("background-color: light gray; border: 1px solid black;")
+        self.useAutoGuessesButton = QtWidgets.QPushButton("Use Automatic Estimates (Enter)")
+        self.useAutoGuessesButton.clicked.connect(self.UseAutoGuesses)
+
+        hbox2 = QtWidgets.QHBoxLayout()
+        hbox2.addWidget(self.thresholdText)
+        hbox2.addWidget(self.thresholdBox)
+        hbox2.addWidget(self.phaseBox)
+        hbox2.addWidget(self.autoEstimateText, stretch=2)
+        hbox2.addWidget(self.useAutoGuessesButton)
+
         vbox = QtWidgets.QVBoxLayout()
 
         self.sc = MplCanvas(self, width=7, height=7, dpi=100)
         vbox.addWidget(self.sc)
         vbox.addWidget(self.buttonRegion)
+        vbox.addLayout(hbox2)
         self.setLayout(vbox)
 
-    def ReadImage(self, imagePath, numStrata, countAreaType, countAreaBounds=None):
+    def ReadImage(self, imagePath, numStrata, countAreaType, countAreaBounds=None, layout=None, prepared=None):
+        # prepared is the result of PrepareImage when the image was set up in the background
         self.imagePath = imagePath
-        self.originalImage = io.imread(imagePath)
+        self.originalImage = self.parentTab.imageStore.GetImage(imagePath)
         self.numStrata = numStrata
         self.initialGuesses = []
         self.countAreaType = countAreaType
         self.countAreaBounds = countAreaBounds
         
-        self.myMap = PixelMap(self.originalImage)
-        self.N = self.myMap.numPixels
+        if prepared is None:
+            self.myMap = self.parentTab.imageStore.GetPixelMap(imagePath)
+            self.strataMap = StrataMap(self.myMap.rows, self.myMap.cols, numStrata, countAreaType, countAreaBounds, layout)
+        else:
+            self.myMap = prepared["pixelMap"]
+            self.strataMap = prepared["strataMap"]
+        self.numStrata = self.strataMap.numStrata # polygon areas drop the grid cells outside the polygon
+        self.N = self.strataMap.N
         
         self.strataIndex = 0
+        if prepared is None:
+            self.StartPreviews()
+            self.EstimateGuesses()
+        else:
+            for future in self.previews:
+                future.cancel()
+            self.previews = prepared["previews"]
+            self.autoGuesses = prepared["autoGuesses"]
+            self.autoThreshold = prepared["autoThreshold"]
+            self.UpdateAutoEstimateText()
         self.DisplayStrata()
+        self.setFocus(QtCore.Qt.NoFocusReason) # Needed or the keyboard will not work
 
-    def LogEstimate(self, value):
-        self.initialGuesses.append(value)
+    def PrepareImage(self, imagePath, numStrata, countAreaType, countAreaBounds, layout, threshold, darkPhase, displaySize) -> dict:
+        # Decode, strata, automatic estimates and queued previews of an image, run on a background thread so it does not touch any widgets
+        pixelMap = self.parentTab.imageStore.GetPixelMap(imagePath)
+        strataMap = StrataMap(pixelMap.rows, pixelMap.cols, numStrata, countAreaType, countAreaBounds, layout)
+        autoGuesses, autoThreshold = EstimatePhaseFractions(pixelMap, strataMap, threshold, darkPhase)
+        previews = [self.previewExecutor.submit(self.RenderPreview, pixelMap, strataMap, i, displaySize) for i in range(strataMap.numStrata)]
+        return {"pixelMap": pixelMap, "strataMap": strataMap, "autoGuesses": autoGuesses, "autoThreshold": autoThreshold, "previews": previews}
+
+    def GetThreshold(self):
+        # None when the box is empty, Otsu picks the threshold then
+        threshold = self.thresholdBox.text().strip()
+        if threshold == "":
+            return None
+        try:
+            value = float(threshold)
+        except ValueError:
+            value = np.nan
+        if not 0 <= value <= 255:
+            raise ValueError(f"Threshold must be a number from 0 to 255, got {threshold}. Using Otsu instead.")
+        return value
+
+    def EstimateGuesses(self):
+        if self.imagePath is None:
+            return
 
-        self.strataIndex += 1
+        try:
+            threshold = self.GetThreshold()
+        except ValueError as e:
+            self.thresholdBox.setText("") # cleared before the message box takes focus, so the box holds what is used
+            threshold = None
+            msg = QtWidgets.QMessageBox()
+            msg.setIcon(QtWidgets.QMessageBox.Critical)
+            msg.setText("Error")
+            msg.setInformativeText(str(e))
+            msg.setWindowTitle("Error")
+            msg.exec_()
+        self.autoGuesses, level = EstimatePhaseFractions(self.myMap, self.strataMap, threshold, self.phaseBox.currentIndex() == 0)
+        self.autoThreshold = level
+        self.UpdateAutoEstimateText()
 
-        if self.strataIndex == self.numStrata:
-            self.parentTab.MoveToConstituentCountWidget()
+    def UpdateAutoEstimateText(self):
+        if self.autoGuesses is None or self.strataIndex >= self.numStrata:
             return
+        self.autoEstimateText.setText(f"Automatic Estimate: {100*self.autoGuesses[self.strataIndex]:.1f}% (threshold {self.autoThreshold:.0f})")
 
-        self.DisplayStrata()
+    def UseAutoGuesses(self):
+        # Strata already estimated by hand keep their guesses, the automatic estimates fill in the rest
+        if self.autoGuesses is None:
+            return
+        self.initialGuesses = self.initialGuesses + [float(g) for g in self.autoGuesses[len(self.initialGuesses):]]
+        self.strataIndex = self.numStrata
+        self.parentTab.MoveToConstituentCountWidget()
 
-    def DisplayStrata(self):
+    def keyPressEvent(self, event):
+        if self.parentTab.stackedWidget.currentIndex() != 1:
+            return
+
+        # Enter in the threshold box only applies the level, the new estimate is shown before it can be accepted
+        if (event.key() == QtCore.Qt.Key_Return or event.key() == QtCore.Qt.Key_Enter) and not self.thresholdBox.hasFocus():
+            self.UseAutoGuesses()
 
+    def StartPreviews(self):
+        # Every stratum view is rendered once in the background, in the order the strata are shown
+        for future in self.previews:
+            future.cancel()
+        displaySize = max(self.sc.get_width_height())
+        self.previews = [self.previewExecutor.submit(self.RenderPreview, self.myMap, self.strataMap, i, displaySize) for i in range(self.numStrata)]
+
+    def RenderPreview(self, pixelMap:PixelMap, strataMap:StrataMap, stratumIndex:int, displaySize:int) -> np.ndarray:
         # left,right,top,bottom bounds are rectangular bounds
         # for full and rectangular crop, this is equal to displayed region
-        # for circular and annular, this is a box around the quarter circle in which the stratum lies
+        # for circular and annular, this is a box around the sector in which the stratum lies
+        # for polygon, this is a box around the grid cells merged into the stratum
+        leftBound, rightBound, topBound, bottomBound = strataMap.GetBounds(stratumIndex)
 
-        if self.countAreaType == "Full":
-            numStrata_N = int(np.sqrt(self.numStrata))
-            unraveledStrataIndex = np.unravel_index(self.strataIndex, (numStrata_N, numStrata_N))
-            row = unraveledStrataIndex[0]
-            col = unraveledStrataIndex[1]
+        # Large strata are read strided to about twice the canvas size, so lazily read images only decode a coarse pyramid level or a subset of tiles
+        step = max(1, max(bottomBound - topBound, rightBound - leftBound) // (2 * displaySize))
+        image = pixelMap.GetCroppedImage(leftBound, rightBound, topBound, bottomBound, step)
 
-            topBound = int(row*self.myMap.rows/numStrata_N)
-            bottomBound = int((row+1)*self.myMap.rows/numStrata_N)
-            leftBound = int(col*self.myMap.cols/numStrata_N)
-            rightBound = int((col+1)*self.myMap.cols/numStrata_N)
+        if strataMap.labels is not None:
+            mask = strataMap.GetLabels(leftBound, rightBound, topBound, bottomBound)[::step, ::step] == stratumIndex
+            if image.ndim == 3:
+                mask = mask[:, :, None]
+            image = np.where(mask, image, 0)
 
-            image = self.myMap.GetCroppedImage(leftBound, rightBound, topBound, bottomBound)   
-        
-        elif self.countAreaType == "Rectangular":
-            numStrata_N = int(np.sqrt(self.numStrata))
-            unraveledStrataIndex = np.unravel_index(self.strataIndex, (numStrata_N, numStrata_N))
-            row = unraveledStrataIndex[0]
-            col = unraveledStrataIndex[1]
-
-            topBound = int(self.countAreaBounds[1] + (row / numStrata_N) * self.countAreaBounds[3])
-            bottomBound = int(self.countAreaBounds[1] + ((row+1) / numStrata_N) * self.countAreaBounds[3])
-            leftBound = int(self.countAreaBounds[0] + (col / numStrata_N) * self.countAreaBounds[2])
-            rightBound = int(self.countAreaBounds[0] + ((col+1) / numStrata_N) * self.countAreaBounds[2])
-
-            image = self.myMap.GetCroppedImage(leftBound, rightBound, topBound, bottomBound)   
-        
-        # countAreaBounds is [center_x, center_y, radius]
-        elif self.countAreaType == "Circular":
-            # Square box around circle
-            topBound = self.countAreaBounds[1] - self.countAreaBounds[2] 
-            bottomBound = self.countAreaBounds[1] + self.countAreaBounds[2]
-            leftBound = self.countAreaBounds[0] - self.countAreaBounds[2]
-            rightBound = self.countAreaBounds[0] + self.countAreaBounds[2]
-
-            # Divide square into appropriate quarter
-            strataFraction = self.strataIndex / self.numStrata
-            if strataFraction < 0.25:
-                leftBound = self.countAreaBounds[0]
-                topBound = self.countAreaBounds[1]
-            elif strataFraction < 0.5:
-                rightBound = self.countAreaBounds[0]
-                topBound = self.countAreaBounds[1]
-            elif strataFraction < 0.75:
-                rightBound = self.countAreaBounds[0]
-                bottomBound = self.countAreaBounds[1]
-            else:
-                leftBound = self.countAreaBounds[0]
-                bottomBound = self.countAreaBounds[1]
-            
-            # find points along radius that divide circle into strata
-            thetas = np.linspace(0,2*np.pi, self.numStrata+1)
-            
-            image = self.myMap.originalImage
-            # Example parameters
-            height, width = len(image), len(image[0])
-            center = (self.countAreaBounds[0], self.countAreaBounds[1])
-            radius = self.countAreaBounds[2]
-            theta1 = thetas[self.strataIndex]   # Start angle in radians
-            theta2 = thetas[self.strataIndex+1]  # End angle in radians
-
-            # Create a blank mask
-            mask = np.zeros((height, width), dtype=np.uint8)
-
-            # Generate points along the arc
-            num_points = 50
-            thetas = np.linspace(theta1, theta2, num_points)
-            arc_points = np.array([
-                (
-                    int(center[0] + radius * np.cos(theta)),
-                    int(center[1] + radius * np.sin(theta))
-                )
-                for theta in thetas
-            ])
-            
-            # Combine center and arc points to form the sector polygon
-            polygon = np.vstack([center, arc_points, center])
-
-            # Draw the filled polygon on the mask
-            cv2.fillPoly(mask, [polygon], 255)
-
-            # Apply mask to image (assuming grayscale)
-            masked_image = cv2.bitwise_and(image, image, mask=mask)
-            image = masked_image[topBound:bottomBound, leftBound:rightBound]
-              
-        elif self.countAreaType == "Annular":
-            # Annular sector mask
-            # countAreaBounds: [center_x, center_y, inner_radius, outer_radius]
-            center_x, center_y, inner_radius, outer_radius = self.countAreaBounds
-
-            # Bounds for cropping (outer square)
-            topBound = int(center_y - outer_radius)
-            bottomBound = int(center_y + outer_radius)
-            leftBound = int(center_x - outer_radius)
-            rightBound = int(center_x + outer_radius)
-
-            # Divide square into appropriate quarter
-            strataFraction = self.strataIndex / self.numStrata
-            if strataFraction < 0.25:
-                leftBound = self.countAreaBounds[0]
-                topBound = self.countAreaBounds[1]
-            elif strataFraction < 0.5:
-                rightBound = self.countAreaBounds[0]
-                topBound = self.countAreaBounds[1]
-            elif strataFraction < 0.75:
-                rightBound = self.countAreaBounds[0]
-                bottomBound = self.countAreaBounds[1]
-            else:
-                leftBound = self.countAreaBounds[0]
-                bottomBound = self.countAreaBounds[1]
-
-            # Angles for this stratum
-            thetas = np.linspace(0, 2 * np.pi, self.numStrata + 1)
-            theta1 = thetas[self.strataIndex]
-            theta2 = thetas[self.strataIndex + 1]
-
-            # Create mask
-            image = self.myMap.originalImage
-            height, width = image.shape[:2]
-            mask = np.zeros((height, width), dtype=np.uint8)
-
-            # Outer arc points
-            num_points = 50
-            arc_outer = np.array([
-                (
-                    int(center_x + outer_radius * np.cos(theta)),
-                    int(center_y + outer_radius * np.sin(theta))
-                )
-                for theta in np.linspace(theta1, theta2, num_points)
-            ])
-            # Inner arc points (reverse order)
-            arc_inner = np.array([
-                (
-                    int(center_x + inner_radius * np.cos(theta)),
-                    int(center_y + inner_radius * np.sin(theta))
-                )
-                for theta in np.linspace(theta2, theta1, num_points)
-            ])
-
-            # Combine to form annular sector polygon
-            polygon = np.vstack([arc_outer, arc_inner])
-
-            # Draw filled polygon on mask
-            cv2.fillPoly(mask, [polygon], 255)
-
-            # Apply mask to image (handles grayscale or RGB)
-            if image.ndim == 2:
-                masked_image = cv2.bitwise_and(image, image, mask=mask)
-            else:
-                masked_image = cv2.bitwise_and(image, image, mask=mask)
+        # Area averaging down to the canvas size keeps fine features visible where striding alone would alias
+        scale = displaySize / max(image.shape[:2])
+        if scale < 1:
+            image = cv2.resize(np.ascontiguousarray(image), (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))), interpolation=cv2.INTER_AREA)
 
-            # Crop to bounding box
-            image = masked_image[topBound:bottomBound, leftBound:rightBound]
+        return image
 
+    def LogEstimate(self, value):
+        self.initialGuesses.append(value)
 
-        self.sc.axes.cla()
-        self.sc.axes.imshow(image, cmap="gray")
-        self.sc.axes.set_yticks([])
-        self.sc.axes.set_xticks([])
-        self.sc.draw()
+        self.strataIndex += 1
+
+        if self.strataIndex == self.numStrata:
+            self.parentTab.MoveToConstituentCountWidget()
+            return
+
+        self.DisplayStrata()
+        self.UpdateAutoEstimateText()
+        self.setFocus(QtCore.Qt.NoFocusReason) # Needed or the keyboard will not work
+
+    def DisplayStrata(self):
+        # Only waits if the background worker has not reached this stratum yet
+        self.sc.ShowImage(self.previews[self.strataIndex].result(), cmap="gray")
 
 
 class ConstituentCountingWidget(QtWidgets.QWidget):
@@ -821,7 +2113,15 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
 
         self.parentTab = parentTab
 
-        self.allocationStrategy = None
+        self.allocationStrategy = "Equal" # Equal, Neyman or Two-Phase
+        self.pilotFraction = 0.3 # share of the Neyman plan counted as the pilot batch in two-phase allocation
+        self.sequentialStopping = False # end as soon as the live CI meets the MOE, strata are then visited round robin
+        self.minSamplesPerStratum = 5 # points every stratum needs before the measurement may stop early
+        self.sharedAddress = None # (host, port) a shared count listens on, None counts alone
+        self.coordinator = None # CountingCoordinator of a shared count hosted here
+        self.chunkSource = None # hands out the points of a shared count, the coordinator here or a connection to another instance
+        self.sharedTimer = QtCore.QTimer(self)
+        self.sharedTimer.timeout.connect(self.PollSharedCounting)
 
         self.displayToggle = 0
 
@@ -839,8 +2139,13 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
         self.indexProgressText.setAlignment(QtCore.Qt.AlignCenter)
         self.indexProgressText.setStyleSheet("background-color: light gray; border: 1px solid black;")
 
+        self.liveEstimateText = QtWidgets.QLabel("Estimate: --")
+        self.liveEstimateText.setAlignment(QtCore.Qt.AlignCenter)
+        self.liveEstimateText.setStyleSheet("background-color: light gray; border: 1px solid black;")
+
         hbox2.addWidget(self.lastEntryText)
         hbox2.addWidget(self.indexProgressText)
+        hbox2.addWidget(self.liveEstimateText)
         
         self.zoomOutButton = QtWidgets.QPushButton("Zoom Out")
         self.zoomOutButton.clicked.connect(self.ZoomOut)
@@ -852,8 +2157,21 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
 
         vbox.addLayout(hbox2)
         vbox.addWidget(self.sc)
+
+        # Latency debug overlay drawn over the canvas, toggled with P when profiling is enabled
+        self.profileText = QtWidgets.QLabel(self.sc)
+        self.profileText.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace; font-size: 10px; padding: 2px;")
+        self.profileText.hide()
+        self.profileFrames = 0
+
         hbox = QtWidgets.QHBoxLayout()
 
+        # Key legend, arrow keys for a single phase or one number key per phase
+        self.phaseKeysText = QtWidgets.QLabel("")
+        self.phaseKeysText.setAlignment (QtCore.Qt.AlignCenter)
+        self.phaseKeysText.setStyleSheet("background-color: light gray; border: 1px solid black;")
+        self.phaseKeysText.hide()
+
         leftText = QtWidgets.QLabel("Left Arrow Key For 0")
         leftText.setAlignment (QtCore.Qt.AlignCenter)
         leftText.setStyleSheet("background-color: light gray; border: 1px solid black;")
@@ -877,7 +2195,10 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
         hbox.addWidget(leftText)
         hbox.addLayout(vbox2)
         hbox.addWidget(rightText)
-        vbox.addLayout(hbox)
+        self.arrowKeysRegion = QtWidgets.QWidget()
+        self.arrowKeysRegion.setLayout(hbox)
+        vbox.addWidget(self.arrowKeysRegion)
+        vbox.addWidget(self.phaseKeysText)
 
         self.setLayout(vbox)
         
@@ -886,209 +2207,375 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
         self.e_moe = 0.01
         self.d = 0.9
 
-    def InitializeCounting(self, initialGuesses, imagePath, countAreaType, countAreaBounds, confidence, MOE):
+        self.seed = None # set to an int for a reproducible sample plan
+
+        self.gridColor = (50, 225, 248)
+        self.numPrefetch = 8 # upcoming samples rendered in the background
+        self.viewportCache = None
+
+        self.SetPhases([], [])
+
+    @staticmethod
+    def ParsePhases(text:str) -> tuple:
+        # "Pore, Carbide, Matrix" counts three phases on keys 1, 2 and 3, "Pore:7" sets the key of a phase, blank is the single phase mode
+        entries = [entry.strip() for entry in text.split(",") if entry.strip() != ""]
+        if len(entries) == 0:
+            return [], []
+        if len(entries) == 1:
+            raise ValueError("Counting several phases needs at least two phases, leave the phases blank to count a single phase.")
+
+        phaseNames, phaseKeys = [], []
+        for i, entry in enumerate(entries):
+            name, _, key = entry.partition(":")
+            key = key.strip() or str((i + 1) % 10)
+            if len(key) != 1 or not key.isdigit():
+                raise ValueError(f"Phase {name.strip()} must use a number key, got {key}.")
+            phaseNames.append(name.strip())
+            phaseKeys.append(key)
+        if len(set(phaseKeys)) != len(phaseKeys):
+            raise ValueError("Every phase needs its own number key.")
+        return phaseNames, phaseKeys
+
+    def SetPhases(self, phaseNames:list, phaseKeys:list):
+        # Every point is recorded as a class. With no phase names the classes are 0, 0.5 and 1 of a single phase, otherwise each class is one phase
+        # classValues[c, k] is what a point of class c adds to the area fraction of phase k
+        self.phaseNames = list(phaseNames)
+        self.phaseKeys = list(phaseKeys)
+        if len(phaseNames) == 0:
+            self.classValues = np.array([[0], [0.5], [1]])
+            self.classNames = ["0", "0.5", "1"]
+            self.classKeys = {QtCore.Qt.Key_Left: 0, QtCore.Qt.Key_Up: 1, QtCore.Qt.Key_Right: 2}
+        else:
+            self.classValues = np.eye(len(phaseNames))
+            self.classNames = list(phaseNames)
+            self.classKeys = {ord(key): i for i, key in enumerate(phaseKeys)} # Qt codes of digit keys are their ASCII codes
+            self.phaseKeysText.setText("    ".join(f"{key}: {name}" for name, key in zip(phaseNames, phaseKeys)) + "    Down Arrow Key To Go Back")
+        self.numPhases = self.classValues.shape[1]
+        self.arrowKeysRegion.setVisible(len(phaseNames) == 0)
+        self.phaseKeysText.setVisible(len(phaseNames) > 0)
+
+    def InitializeCounting(self, initialGuesses, imagePath, countAreaType, countAreaBounds, confidence, MOE, strataMap=None):
+        startTime = profiler.Now()
 
         self.numStrata = len(initialGuesses)
         self.imageName = imagePath
-        image = io.imread(imagePath)
-        self.myMap = PixelMap(image)
-        self.N = self.myMap.numPixels
-        self.N_h = int(self.N / self.numStrata)
+        self.myMap = self.parentTab.imageStore.GetPixelMap(imagePath)
+        if strataMap is None:
+            strataMap = StrataMap(self.myMap.rows, self.myMap.cols, self.numStrata, countAreaType, countAreaBounds)
+        self.strataMap = strataMap
+        self.layout = strataMap.layout
+        self.N = strataMap.N
+        self.N_h = strataMap.counts # exact number of pixels in each stratum
+        self.rng = np.random.default_rng(self.seed)
         self.confidence = confidence
+        self.MOE = MOE
+        self.countAreaType = countAreaType
+        self.countAreaBounds = countAreaBounds
+        self.initialGuesses = initialGuesses
         self.strataIndex = 0
         self.sampleIndex = 0
+
+        if self.sharedAddress is not None:
+            # Every operator counts a different part of the plan, there is no early stop or second phase to agree on
+            if self.allocationStrategy == "Two-Phase":
+                print("A shared count cannot use two-phase allocation, using Neyman")
+                self.allocationStrategy = "Neyman"
+            self.sequentialStopping = False
         
         W_h = self.N_h / self.N
+        self.W_h = W_h
 
         # ############################################################################ #
         # Calculate the total number of samples needed to acheieve specified precision #
         # ############################################################################ #
 
-        initialStrataProportion = np.sum(initialGuesses) * self.N_h / self.N
-        
-        if initialStrataProportion > 0.5 and MOE > 1-initialStrataProportion:
-            MOE = ((1-initialStrataProportion)+MOE) / 2 # want to keep +- MOE as close as possible on the open side. so if p=0.01, with 5% MOE, the CI should be (0,0.06)
-            print(f"MOE stretches beyond range of [0,1] based on initial guess, reducing to {initialStrataProportion:.2f}")
-        elif initialStrataProportion < 0.5 and MOE > initialStrataProportion:
-            MOE = (initialStrataProportion + MOE) / 2
-            print(f"MOE stretches beyond range of [0,1] based on initial guess, reducing to {initialStrataProportion:.2f}")
-        
-        p_st = np.sum(W_h * initialGuesses)
-        q_st = 1 - p_st
+        allocation = "Neyman" if self.allocationStrategy == "Two-Phase" else self.allocationStrategy
+        planningGuesses = SampleSizeSolver.WorstCaseGuesses(initialGuesses, self.numPhases)
+        neff, n_h = SampleSizeSolver.Plan(planningGuesses, W_h, MOE, self.confidence, allocation)
+        if self.allocationStrategy == "Two-Phase":
+            # Pilot batch only, the rest of the budget is allocated from the p_h observed in it
+            n_h = np.maximum(2, np.ceil(self.pilotFraction * n_h)).astype(np.int64)
 
-        neff_func = lambda x: MOE - ((scipy.stats.binom.interval(0.95, x, p_st)[1]/x - scipy.stats.binom.interval(0.95, x, p_st)[0]/x) / 2)
-
-        # NOTE: scipy CP interval reports expected number of successes
-        # NOTE: scipy fsolve does not work for this, using alternative lookup table method
-        testVals = np.arange(1,10000)
-        return_vals = neff_func(testVals)
-
-        neff = testVals[np.argmin(np.abs(return_vals))]
-        neff = np.ceil(neff/ self.numStrata) * self.numStrata
+        SampleSizeSolver.CheckFits(n_h, self.N_h)
 
         self.neff = neff
-
-        nh_func = lambda x: neff - ((p_st * q_st) / np.sum((W_h**2 * initialGuesses * (1-initialGuesses)) / (x - 1)))
-        
-        n_h = scipy.optimize.fsolve(nh_func, np.array([2]))[0]
-        
-        n_h = np.ceil(n_h)
-        n_h = np.ones(self.numStrata, dtype=np.int16) * int(n_h)
-
         self.n_h = n_h
 
         # ########################## #
         # Get pixel sample locations #
         # ########################## #
-        pixels = []
-
-        if countAreaType == "Full":
-
-            numStrata_N = int(np.sqrt(self.numStrata))
-
-            for i in range(self.numStrata):
-                unraveledStrataIndex = np.unravel_index(i, (numStrata_N, numStrata_N))
-                row = unraveledStrataIndex[0]
-                col = unraveledStrataIndex[1]
+        rows, cols, strata = strataMap.SampleStrata(n_h, self.rng)
+        
+        self.samplePositions = list(zip(rows.tolist(), cols.tolist())) # (row, col) of every point in the order they are counted
+        self.pointStrata = strata # stratum of every point
+        self.reallocated = False
 
-                topBound = int(row*self.myMap.rows/numStrata_N)
-                bottomBound = int((row+1)*self.myMap.rows/numStrata_N)
+        if self.sequentialStopping:
+            order = self.GetInterleavedOrder(self.pointStrata)
+            self.samplePositions = [self.samplePositions[i] for i in order]
+            self.pointStrata = self.pointStrata[order]
 
-                leftBound = int(col*self.myMap.cols/numStrata_N)
-                rightBound = int((col+1)*self.myMap.cols/numStrata_N)
+        if self.sharedAddress is not None and self.HostSharedCounting():
+            profiler.Record("plan", startTime)
+            return
 
-                random = np.random.choice(np.arange(0,((bottomBound-topBound) * (rightBound-leftBound))), n_h[i], replace=False)
-                random = np.array(np.unravel_index(random, (bottomBound-topBound,rightBound-leftBound)))
-                random[0,:] += topBound
-                random[1,:] += leftBound
-            
-                pixels.append(list(zip(random[0,:], random[1,:])))
+        self.ResetCounting()
+        profiler.Record("plan", startTime)
 
-        elif countAreaType == "Rectangular":
-
-            numStrata_N = int(np.sqrt(self.numStrata))
-            
-            for i in range(self.numStrata):
-                unraveledStrataIndex = np.unravel_index(i, (numStrata_N, numStrata_N))
-                row = unraveledStrataIndex[0]
-                col = unraveledStrataIndex[1]
-
-                topBound = int(countAreaBounds[1] + (row / numStrata_N) * countAreaBounds[3])
-                bottomBound = int(countAreaBounds[1] + ((row+1) / numStrata_N) * countAreaBounds[3])
-                leftBound = int(countAreaBounds[0] + (col / numStrata_N) * countAreaBounds[2])
-                rightBound = int(countAreaBounds[0] + ((col+1) / numStrata_N) * countAreaBounds[2])
-
-                random = np.random.choice(np.arange(0,((bottomBound-topBound) * (rightBound-leftBound))), n_h[i], replace=False)
-                random = np.array(np.unravel_index(random, (bottomBound-topBound,rightBound-leftBound)))
-                random[0,:] += topBound
-                random[1,:] += leftBound
-        
-                pixels.append(list(zip(random[0,:], random[1,:])))
-
-        elif countAreaType == "Circular":          
-            # find points along radius that divide circle into strata
-            thetas = np.linspace(0,2*np.pi, self.numStrata+1)
-            
-            image = self.myMap.originalImage
-            # Example parameters
-            height, width = len(image), len(image[0])
-            center = (countAreaBounds[0], countAreaBounds[1])
-            radius = countAreaBounds[2]
-
-            for i in range(self.numStrata):
-                theta1 = thetas[i]   # Start angle in radians
-                theta2 = thetas[i+1]  # End angle in radians
-
-                # Create a blank mask
-                mask = np.zeros((height, width), dtype=np.uint8)
-
-                # Generate points along the arc
-                num_points = 50
-                arc_thetas = np.linspace(theta1, theta2, num_points)
-                arc_points = np.array([
-                    (
-                        int(center[0] + radius * np.cos(theta)),
-                        int(center[1] + radius * np.sin(theta))
-                    )
-                    for theta in arc_thetas
-                ])
-                
-                # Combine center and arc points to form the sector polygon
-                polygon = np.vstack([center, arc_points, center])
-
-                # Draw the filled polygon on the mask
-                cv2.fillPoly(mask, [polygon], 255)
-
-                # Randomly sample points within the masked area
-                ys, xs = np.where(mask == 255)
-                if len(xs) < n_h[i]:
-                    raise ValueError(f"Not enough pixels in stratum {i} to sample {n_h[i]} points.")
-                idx = np.random.choice(len(xs), n_h[i], replace=False)
-                sampled_points = list(zip(ys[idx], xs[idx]))
-                pixels.append(list(sampled_points))
-
-        elif countAreaType == "Annular":
-            center_x, center_y, inner_radius, outer_radius = countAreaBounds
-            height, width = self.myMap.originalImage.shape[:2]
-            thetas = np.linspace(0, 2 * np.pi, self.numStrata + 1)
-
-            for i in range(self.numStrata):
-                theta1 = thetas[i]
-                theta2 = thetas[i + 1]
-
-                # Create mask for this annular sector
-                mask = np.zeros((height, width), dtype=np.uint8)
-
-                # Outer arc points
-                num_points = 50
-                arc_outer = np.array([
-                    (
-                        int(center_x + outer_radius * np.cos(theta)),
-                        int(center_y + outer_radius * np.sin(theta))
-                    )
-                    for theta in np.linspace(theta1, theta2, num_points)
-                ])
-                # Inner arc points (reverse order)
-                arc_inner = np.array([
-                    (
-                        int(center_x + inner_radius * np.cos(theta)),
-                        int(center_y + inner_radius * np.sin(theta))
-                    )
-                    for theta in np.linspace(theta2, theta1, num_points)
-                ])
-
-                # Combine to form annular sector polygon
-                polygon = np.vstack([arc_outer, arc_inner])
-
-                # Draw filled polygon on mask
-                cv2.fillPoly(mask, [polygon], 255)
-
-                # Randomly sample points within the masked area
-                ys, xs = np.where(mask == 255)
-                if len(xs) < n_h[i]:
-                    raise ValueError(f"Not enough pixels in annular stratum {i} to sample {n_h[i]} points.")
-                idx = np.random.choice(len(xs), n_h[i], replace=False)
-                sampled_points = list(zip(ys[idx], xs[idx]))
-                pixels.append(list(sampled_points))
-        
-        self.samplePositions = pixels # First axis is strata axis, second axis is sample axis
-        self.numGrids = np.sum(n_h)
+        self.parentTab.sessionJournal.Start(self.GetJournalHeader())
 
         # ############# #
         # Begin display #
         # ############# #
 
-        self.sampleIndex = 0
-        self.strataIndex = 0
-        self.gridIndex = 0 # Used to track flattend index, useful for writing to 1D poreData
+        self.UpdateProgressText()
+
+        self.UpdateDisplay()
 
-        self.poreData = np.zeros((self.numGrids))
-        self.indexProgressText.setText(f"Sample: {self.sampleIndex+1}/{self.n_h[self.strataIndex]}, Strata: {self.strataIndex+1}/{self.numStrata}")
+        self.setFocus(QtCore.Qt.NoFocusReason) # Needed or the keyboard will not work
 
+    def ResetCounting(self):
+        if self.viewportCache is not None:
+            self.viewportCache.Shutdown()
+        self.viewportCache = ViewportCache(self.myMap, self.samplePositions, self.gridColor)
+
+        self.numGrids = len(self.samplePositions)
+        self.pointSamples = self.GetPointSamples(self.pointStrata)
+        self.gridIndex = 0 # Used to track flattend index, useful for writing to 1D pointClasses
+        self.UpdatePosition()
+
+        self.pointClasses = np.full(self.numGrids, -1, dtype=np.int8) # class of every point, -1 until it is counted
+
+        # Running counts of each class over the recorded points of each stratum, updated in O(1) per key
+        self.stratumCounts = np.zeros(self.numStrata, dtype=np.int64)
+        self.stratumClassCounts = np.zeros((self.numStrata, len(self.classValues)), dtype=np.int64)
+        self.liveEstimateText.setText("Estimate: --")
+
+        # Fallback p_h of strata without points, the initial guesses for the first phase and an even split of the rest for the others
+        initialGuesses = np.asarray(self.initialGuesses, dtype=float)
+        self.phaseGuesses = np.repeat(((1 - initialGuesses) / max(self.numPhases - 1, 1))[:, None], self.numPhases, axis=1)
+        self.phaseGuesses[:, 0] = initialGuesses
+
+    @staticmethod
+    def GetPointSamples(pointStrata:np.ndarray) -> np.ndarray:
+        # Index of every point among the points of its own stratum
+        order = np.argsort(pointStrata, kind="stable")
+        sortedStrata = pointStrata[order]
+        pointSamples = np.empty(len(pointStrata), dtype=np.int64)
+        pointSamples[order] = np.arange(len(pointStrata)) - np.searchsorted(sortedStrata, sortedStrata)
+        return pointSamples
+
+    @staticmethod
+    def GetInterleavedOrder(pointStrata:np.ndarray) -> np.ndarray:
+        # Visit order that advances every stratum in proportion to its number of points, so an early stop leaves no stratum unsampled
+        pointSamples = ConstituentCountingWidget.GetPointSamples(pointStrata)
+        n_h = np.bincount(pointStrata)
+        return np.argsort((pointSamples + 0.5) / n_h[pointStrata], kind="stable")
+
+    def UpdatePosition(self):
+        # Stratum of the current point and its index within the stratum, used for display
+        if self.gridIndex < self.numGrids:
+            self.strataIndex = int(self.pointStrata[self.gridIndex])
+            self.sampleIndex = int(self.pointSamples[self.gridIndex])
+
+    def GetSecondPhase(self) -> dict:
+        # Neyman allocation of the whole budget from the pilot p_h, shrunk away from 0 and 1 so no stratum is planned with zero variance
+        # With several phases each stratum is planned for the phase observed with the largest variance
+        pilotCounts = self.stratumCounts
+        observedPhases = (self.stratumClassCounts @ self.classValues + 0.5) / (pilotCounts + 1)[:, None]
+        observedGuesses = observedPhases[np.arange(self.numStrata), np.argmax(observedPhases * (1 - observedPhases), axis=1)]
+        neff, n_h = SampleSizeSolver.Plan(observedGuesses, self.W_h, self.MOE, self.confidence, "Neyman")
+
+        if self.strataMap is None:
+            self.strataMap = StrataMap(self.myMap.rows, self.myMap.cols, self.numStrata, self.countAreaType, self.countAreaBounds, self.layout)
+
+        # Drawing the extra points plus the pilot size leaves at least numExtra points in each stratum after dropping pilot duplicates
+        numExtra = np.maximum(np.minimum(n_h, self.N_h) - pilotCounts, 0)
+        numDrawn = np.where(numExtra > 0, np.minimum(numExtra + pilotCounts, self.N_h), 0)
+        drawnRows, drawnCols, drawnStrata = self.strataMap.SampleStrata(numDrawn, self.rng)
+
+        pilotPositions = set(self.samplePositions)
+        keep = np.array([(row, col) not in pilotPositions for row, col in zip(drawnRows.tolist(), drawnCols.tolist())], dtype=bool)
+        drawnRows, drawnCols, drawnStrata = drawnRows[keep], drawnCols[keep], drawnStrata[keep]
+        ranks = np.arange(len(drawnStrata)) - np.searchsorted(drawnStrata, drawnStrata)
+        keep = ranks < numExtra[drawnStrata]
+        rows, cols, strata = drawnRows[keep].tolist(), drawnCols[keep].tolist(), drawnStrata[keep].tolist()
+
+        if self.sequentialStopping and len(strata) > 0:
+            order = self.GetInterleavedOrder(np.array(strata))
+            rows, cols, strata = [rows[j] for j in order], [cols[j] for j in order], [strata[j] for j in order]
+
+        return {"neff": float(neff), "rows": rows, "cols": cols, "strata": strata}
+
+    def ApplySecondPhase(self, secondPhase:dict):
+        self.samplePositions.extend(zip(secondPhase["rows"], secondPhase["cols"])) # extended in place, the viewport cache holds this list
+        self.pointStrata = np.concatenate([self.pointStrata, np.array(secondPhase["strata"], dtype=self.pointStrata.dtype)])
+        self.pointSamples = self.GetPointSamples(self.pointStrata)
+        self.pointClasses = np.concatenate([self.pointClasses, np.full(len(secondPhase["strata"]), -1, dtype=np.int8)])
+        self.numGrids = len(self.samplePositions)
+        self.n_h = np.bincount(self.pointStrata, minlength=self.numStrata).astype(np.int64)
+        self.neff = secondPhase["neff"]
+        self.reallocated = True
+        self.UpdatePosition()
+
+    def GetJournalHeader(self) -> dict:
+        # Everything needed to rebuild the session without replanning
+        positions = np.array(self.samplePositions).reshape(-1, 2)
+        return {
+            "imagePath": os.path.abspath(self.imageName),
+            "countAreaType": self.countAreaType,
+            "countAreaBounds": None if self.countAreaBounds is None else [int(b) for b in self.countAreaBounds],
+            "confidence": self.confidence,
+            "MOE": self.MOE,
+            "initialGuesses": [float(g) for g in self.initialGuesses],
+            "N_h": [int(n) for n in self.N_h],
+            "layout": list(self.layout),
+            "neff": float(self.neff),
+            "n_h": [int(n) for n in self.n_h],
+            "allocationStrategy": self.allocationStrategy,
+            "sequentialStopping": self.sequentialStopping,
+            "phaseNames": self.phaseNames,
+            "phaseKeys": self.phaseKeys,
+            "rows": positions[:, 0].tolist(),
+            "cols": positions[:, 1].tolist(),
+            "strata": self.pointStrata.tolist(),
+        }
+
+    def LoadPlan(self, header:dict):
+        # Settings and sample plan of a journal header
+        self.numStrata = len(header["n_h"])
+        self.imageName = header["imagePath"]
+        self.myMap = self.parentTab.imageStore.GetPixelMap(self.imageName)
+        self.strataMap = None
+        self.N_h = np.array(header["N_h"])
+        self.layout = tuple(header["layout"])
+        self.N = int(np.sum(self.N_h))
+        self.W_h = self.N_h / self.N
+        self.confidence = header["confidence"]
+        self.MOE = header["MOE"]
+        self.countAreaType = header["countAreaType"]
+        self.countAreaBounds = header["countAreaBounds"]
+        self.initialGuesses = np.array(header["initialGuesses"])
+        self.neff = header["neff"]
+        self.n_h = np.array(header["n_h"], dtype=np.int64)
+        self.allocationStrategy = header["allocationStrategy"]
+        self.sequentialStopping = header["sequentialStopping"]
+        self.SetPhases(header["phaseNames"], header["phaseKeys"])
+        self.rng = np.random.default_rng(self.seed)
+
+        self.samplePositions = list(zip(header["rows"], header["cols"]))
+        self.pointStrata = np.array(header["strata"], dtype=np.int64)
+        self.reallocated = False
+
+    def ResumeCounting(self, header:dict, values:list):
+        self.LoadPlan(header)
+
+        # Journal entries are recorded classes, or the second phase of a two-phase allocation
+        self.ResetCounting()
+        for entry in values:
+            if isinstance(entry, dict):
+                self.ApplySecondPhase(entry)
+            else:
+                self.AdvanceState(entry)
+        self.parentTab.sessionJournal.Resume()
+
+        if self.gridIndex >= self.numGrids or self.CanStopEarly():
+            self.CompleteCounting()
+            return
+
+        self.UpdateLiveEstimateText()
+        self.UpdateProgressText()
         self.UpdateDisplay()
+        self.setFocus(QtCore.Qt.NoFocusReason) # Needed or the keyboard will not work
 
+    def HostSharedCounting(self) -> bool:
+        # The plan goes to a coordinator that other instances join, the operator here counts chunks of it like any of them
+        try:
+            coordinator = CountingCoordinator(self.GetJournalHeader(), len(self.classValues), self.parentTab.shareToken, self.sharedAddress)
+        except OSError as e:
+            self.parentTab.ShowMessage("Error", f"Cannot share the count on {self.sharedAddress[0]}:{self.sharedAddress[1]}, counting alone: {e}")
+            return False
+        self.coordinator = coordinator
+        self.StartSharedCounting(LocalCountingClient(coordinator, self.parentTab.operator))
+        self.parentTab.ShowMessage("Shared Count", f"Sharing the count of {os.path.basename(self.imageName)} on {self.sharedAddress[0]}:{self.sharedAddress[1]}, other operators join with the share token {self.parentTab.shareToken}", QtWidgets.QMessageBox.Information)
+        return True
+
+    def JoinSharedCounting(self, client:CountingClient):
+        self.LoadPlan(client.plan)
+        self.StartSharedCounting(client)
+
+    def StartSharedCounting(self, chunkSource):
+        # samplePositions only holds the chunks handed out to this operator, in the order they are counted
+        self.chunkSource = chunkSource
+        self.sharedPositions = list(zip(chunkSource.plan["rows"], chunkSource.plan["cols"]))
+        self.sharedStrata = np.array(chunkSource.plan["strata"], dtype=np.int64)
+        self.pointIndices = [] # index in the shared plan of every point counted here
+        self.samplePositions = []
+        self.pointStrata = np.empty(0, dtype=np.int64)
+        self.ResetCounting()
+        self.sharedTimer.start(1000)
+        self.NextSharedChunk()
         self.setFocus(QtCore.Qt.NoFocusReason) # Needed or the keyboard will not work
 
+    def NextSharedChunk(self):
+        # Every point handed out here is counted, ask the coordinator for more
+        try:
+            status, indices = self.chunkSource.RequestChunk()
+        except (OSError, ValueError, KeyError) as e:
+            self.LeaveSharedCounting(f"Lost the shared count: {e}")
+            return
+
+        if status == "chunk":
+            self.pointIndices.extend(indices)
+            self.samplePositions.extend(self.sharedPositions[i] for i in indices) # extended in place, the viewport cache holds this list
+            self.pointStrata = np.concatenate([self.pointStrata, self.sharedStrata[indices]])
+            self.pointSamples = self.GetPointSamples(self.pointStrata)
+            self.pointClasses = np.concatenate([self.pointClasses, np.full(len(indices), -1, dtype=np.int8)])
+            self.numGrids = len(self.samplePositions)
+            self.UpdatePosition()
+            self.UpdateProgressText()
+            self.UpdateDisplay()
+        elif status == "wait":
+            self.UpdateProgressText()
+        elif self.coordinator is not None:
+            self.FinishSharedCounting()
+        else:
+            self.LeaveSharedCounting(f"The shared count is finished, {self.gridIndex} points were counted here", QtWidgets.QMessageBox.Information)
+
+    def PollSharedCounting(self):
+        # Picks up points returned by clients that left, and refreshes the estimate merged from every operator
+        if self.gridIndex >= self.numGrids:
+            self.NextSharedChunk()
+        if self.chunkSource is not None:
+            self.UpdateLiveEstimateText()
+            self.UpdateProgressText()
+
+    def FinishSharedCounting(self):
+        # The merged classes of every operator replace the chunks counted here and the measurement is saved as usual
+        self.stratumCounts, self.stratumClassCounts, _ = self.coordinator.GetCounts()
+        self.pointClasses = self.coordinator.GetClasses()
+        self.samplePositions = self.sharedPositions
+        self.pointStrata = self.sharedStrata
+        self.numGrids = self.gridIndex = len(self.samplePositions)
+        self.CloseSharedCounting()
+        self.FinishCounting()
+
+    def LeaveSharedCounting(self, message:str, icon=QtWidgets.QMessageBox.Critical):
+        # Clients keep no results, the coordinating instance saves the measurement
+        # Closed before the message box so the poll timer does not fire while it is open
+        self.CloseSharedCounting()
+        self.parentTab.MoveToSetupWidget()
+        self.parentTab.ShowMessage("Error" if icon == QtWidgets.QMessageBox.Critical else "Shared Count", message, icon)
+
+    def CloseSharedCounting(self):
+        self.sharedTimer.stop()
+        if self.chunkSource is not None:
+            self.chunkSource.Close()
+            self.chunkSource = None
+        if self.coordinator is not None:
+            self.coordinator.Shutdown()
+            self.coordinator = None
+
     def ZoomOut(self):
         if self.numSurroundingPixels < 300:
             self.numSurroundingPixels += 25
@@ -1129,15 +2616,11 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
         if self.parentTab.stackedWidget.currentIndex() != 2:
             return
         
-        if event.key() == QtCore.Qt.Key_Left:
-            self.RecordDataPoint(0)
-            self.lastEntryText.setText("Last Data Entry: 0")
-        elif event.key() == QtCore.Qt.Key_Up:
-            self.RecordDataPoint(0.5)
-            self.lastEntryText.setText("Last Data Entry: 0.5")
-        elif event.key() == QtCore.Qt.Key_Right:
-            self.RecordDataPoint(1)
-            self.lastEntryText.setText("Last Data Entry: 1")
+        startTime = profiler.Now()
+        if event.key() in self.classKeys:
+            classIndex = self.classKeys[event.key()]
+            self.RecordDataPoint(classIndex)
+            self.lastEntryText.setText(f"Last Data Entry: {self.classNames[classIndex]}")
         elif event.key() == QtCore.Qt.Key_Down:
             self.RecordDataPoint(-1)
             self.lastEntryText.setText("Last Data Entry: Back")
@@ -1147,65 +2630,229 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
             self.ZoomOut()
         elif event.key() == QtCore.Qt.Key_H:
             self.ToggleDisplay()
+        elif event.key() == QtCore.Qt.Key_P and profiler.enabled:
+            self.profileText.setVisible(not self.profileText.isVisible())
+            self.UpdateProfileText()
+            return
         else:
-            pass
+            return
+        profiler.Record("keyToFrame", startTime)
     
-    def RecordDataPoint(self, value):
+    def RecordDataPoint(self, classIndex):
+        if self.chunkSource is not None:
+            self.RecordSharedDataPoint(classIndex)
+            return
+
+        self.parentTab.sessionJournal.Append(classIndex)
+        self.AdvanceState(classIndex)
+
+        if self.gridIndex >= self.numGrids or (classIndex != -1 and self.CanStopEarly()):
+            self.CompleteCounting()
+            return
+
+        self.UpdateLiveEstimateText()
+
+        self.UpdateProgressText()
+
+        self.UpdateDisplay()
+
+    def RecordSharedDataPoint(self, classIndex):
+        # Every class goes to the coordinator as it is recorded, the end of a chunk asks for the next one
+        if classIndex != -1 and self.gridIndex >= self.numGrids: # waiting for points
+            return
+        self.AdvanceState(classIndex)
+
+        index = self.gridIndex - 1 if classIndex != -1 else self.gridIndex
+        try:
+            if index < self.numGrids:
+                self.chunkSource.Label(self.pointIndices[index], classIndex)
+        except OSError as e:
+            self.LeaveSharedCounting(f"Lost the shared count: {e}")
+            return
+
+        self.UpdateLiveEstimateText()
+        if self.gridIndex >= self.numGrids:
+            self.NextSharedChunk()
+            return
+
+        self.UpdateProgressText()
+        self.UpdateDisplay()
+
+    def UpdateProgressText(self):
+        if self.chunkSource is None:
+            self.indexProgressText.setText(f"Sample: {self.sampleIndex+1}/{self.n_h[self.strataIndex]}, Strata: {self.strataIndex+1}/{self.numStrata}")
+        elif self.gridIndex >= self.numGrids:
+            self.indexProgressText.setText(f"Waiting for points, {self.gridIndex} counted here")
+        elif self.coordinator is not None:
+            self.indexProgressText.setText(f"Point: {self.gridIndex+1}/{self.numGrids}, Shared: {self.coordinator.GetCounts()[2]}/{len(self.sharedStrata)}")
+        else:
+            self.indexProgressText.setText(f"Point: {self.gridIndex+1}/{self.numGrids}, Strata: {self.strataIndex+1}/{self.numStrata}")
+
+    def AdvanceState(self, classIndex):
+        # Moves the counting position and records the class of the point without touching the display, also used to replay a journal
         # -1 is go back
-        if value == -1 and self.sampleIndex > 0: # move back one sample
-            self.sampleIndex -= 1
+        if classIndex == -1 and self.gridIndex > 0: # move back one sample, its class no longer counts
             self.gridIndex -= 1
-        elif value == -1 and self.sampleIndex == 0 and self.strataIndex > 0: # move to end of last strata
-            self.strataIndex -= 1
-            self.sampleIndex = self.n_h[self.strataIndex] - 1
-            self.gridIndex -= 1
-        elif value == -1 and self.sampleIndex == 0 and self.strataIndex == 0: # at the beginning of samples, do nothing
+            stratum = self.pointStrata[self.gridIndex]
+            self.stratumCounts[stratum] -= 1
+            self.stratumClassCounts[stratum, self.pointClasses[self.gridIndex]] -= 1
+            self.pointClasses[self.gridIndex] = -1
+        elif classIndex == -1: # at the beginning of samples, do nothing
             pass
-        else: # record value
-            self.poreData[self.gridIndex] = value
+        else: # record class
+            self.pointClasses[self.gridIndex] = classIndex
+            stratum = self.pointStrata[self.gridIndex]
+            self.stratumCounts[stratum] += 1
+            self.stratumClassCounts[stratum, classIndex] += 1
             self.gridIndex += 1
 
-            # At last grid index, move to next pore index
-            if self.sampleIndex == self.n_h[self.strataIndex] - 1:
-                self.sampleIndex = 0
-                self.strataIndex += 1           
-            else:
-                self.sampleIndex += 1
-
-        if self.gridIndex >= self.numGrids:
-            p_h = []
-
-            for i, n in enumerate(self.n_h):
-                if i == 0:
-                    bounds = [0, n]
-                else:
-                    bounds = [np.cumsum(self.n_h[:i])[-1], np.cumsum(self.n_h[:i])[-1] + n]
-                p_h.append(np.average(self.poreData[bounds[0]:bounds[1]]))
+        self.UpdatePosition()
+
+    def GetLiveEstimate(self, stratumCounts=None, stratumClassCounts=None) -> tuple:
+        # Stratified estimate and CI of every phase from the points recorded so far, neff is estimated as p_st*q_st / Var(p_st)
+        # Strata fall back to their initial guess until they have points and to the guess variance until they have two
+        # The variance of a stratum is floored by that of its p_h shrunk as (x+0.5)/(n+1), so strata whose points all share one class still add variance
+        # p_h is (strata, phases), the other results have one entry per phase
+        # The counts default to the points recorded here, a shared count passes the merged counts of every operator
+        stratumCounts = self.stratumCounts if stratumCounts is None else stratumCounts
+        stratumClassCounts = self.stratumClassCounts if stratumClassCounts is None else stratumClassCounts
+        counts = stratumCounts[:, None]
+        sums = stratumClassCounts @ self.classValues
+        sumSquares = stratumClassCounts @ self.classValues**2
+        p_h = np.where(counts > 0, sums / np.maximum(counts, 1), self.phaseGuesses)
+        shrunk_h = np.where(counts > 0, (sums + 0.5) / (counts + 1), self.phaseGuesses)
+        s2_h = np.where(counts > 1, np.maximum((sumSquares - counts * p_h**2) / np.maximum(counts - 1, 1), shrunk_h * (1 - shrunk_h)), self.phaseGuesses * (1 - self.phaseGuesses))
+        variance = np.sum(self.W_h[:, None]**2 * np.maximum(s2_h, 0) / np.maximum(counts, 1), axis=0)
+        p_st = self.W_h @ p_h
+        shrunk_st = self.W_h @ shrunk_h
+
+        neff = np.where(variance > 0, np.maximum(1, np.floor(shrunk_st * (1 - shrunk_st) / np.where(variance > 0, variance, 1))), max(1, int(np.sum(stratumCounts))))
+
+        # Clopper-Pearson interval of p_st*neff successes in neff trials, unlike binomial quantiles it does not collapse to a point at p_st of 0 or 1
+        alpha = 1 - self.confidence
+        successes = p_st * neff
+        lowerCL = np.where(successes > 0, scipy.stats.beta.ppf(alpha / 2, np.maximum(successes, 1e-12), neff - successes + 1), 0.0)
+        upperCL = np.where(successes < neff, scipy.stats.beta.ppf(1 - alpha / 2, successes + 1, np.maximum(neff - successes, 1e-12)), 1.0)
+        return p_h, p_st, lowerCL, upperCL, neff
+
+    def CanStopEarly(self) -> bool:
+        # Every phase has to meet the MOE
+        if not self.sequentialStopping or np.min(self.stratumCounts) < min(self.minSamplesPerStratum, np.min(self.n_h)):
+            return False
+        _, _, lowerCL, upperCL, _ = self.GetLiveEstimate()
+        return np.all((upperCL - lowerCL) / 2 <= self.MOE)
+
+    def UpdateLiveEstimateText(self):
+        # The coordinating instance of a shared count shows the estimate merged from every operator
+        mergedCounts = self.coordinator.GetCounts()[:2] if self.coordinator is not None else ()
+        _, p_st, lowerCL, upperCL, _ = self.GetLiveEstimate(*mergedCounts)
+        if len(self.phaseNames) == 0:
+            self.liveEstimateText.setText(f"Estimate: {100*p_st[0]:.1f}% ({int(self.confidence*100)}% CI: {100*lowerCL[0]:.1f}%, {100*upperCL[0]:.1f}%)")
+        else:
+            self.liveEstimateText.setText(", ".join(f"{name}: {100*p:.1f}% ({100*lower:.1f}-{100*upper:.1f}%)" for name, p, lower, upper in zip(self.phaseNames, p_st, lowerCL, upperCL)))
+
+    def CompleteCounting(self):
+        # An early stop drops the points that were never counted
+        if self.gridIndex < self.numGrids:
+            del self.samplePositions[self.gridIndex:]
+            self.pointStrata = self.pointStrata[:self.gridIndex]
+            self.pointClasses = self.pointClasses[:self.gridIndex]
+            self.numGrids = self.gridIndex
+            self.n_h = self.stratumCounts.copy()
+            self.reallocated = True
+            print(f"Stopped early after {self.numGrids} points, the CI meets the {100*self.MOE:.1f}% MOE")
+
+        # End of the planned points, a two-phase allocation continues with its second phase once
+        if self.allocationStrategy == "Two-Phase" and not self.reallocated:
+            secondPhase = self.GetSecondPhase()
+            self.parentTab.sessionJournal.AppendEntry(secondPhase)
+            self.ApplySecondPhase(secondPhase)
+            if self.gridIndex < self.numGrids:
+                self.UpdateProgressText()
+                self.UpdateDisplay()
+                return
+
+        self.FinishCounting()
+
+    def FinishCounting(self):
+        # Results have one entry per phase
+        if self.sequentialStopping:
+            # The stopping rule was checked against the live CI, so that is the one reported
+            p_h, p_st, lowerCL, upperCL, neff = self.GetLiveEstimate()
+        else:
+            p_h = (self.stratumClassCounts @ self.classValues) / self.stratumCounts[:, None]
             
-            W_h = self.N_h / self.N
+            p_st = self.W_h @ p_h
+            neff = np.full(self.numPhases, self.neff)
+            lowerCL, upperCL = scipy.stats.binom.interval(self.confidence, neff, p_st) # NOTE: Scipy interval returns number of successes
+            lowerCL /= neff
+            upperCL /= neff
+
+        for k in range(self.numPhases):
+            self.SaveMeasurement(k, p_h[:, k], p_st[k], lowerCL[k], upperCL[k], neff[k])
+        self.parentTab.sessionJournal.Finish()
+        
+        if len(self.phaseNames) == 0:
+            self.parentTab.MoveToSetupWidget(p_st[0], lowerCL[0], upperCL[0])
+        else:
+            self.parentTab.MoveToSetupWidget(p_st, lowerCL, upperCL, self.phaseNames)
+
+    def SaveMeasurement(self, phaseIndex, p_h, p_st, lowerCL, upperCL, neff):
+        # One measurement per phase, points are stored in counting order with their value for that phase
+        positions = np.array(self.samplePositions).reshape(-1, 2)
+        measurement = {
+            "image_name": os.path.basename(self.imageName),
+            "image_path": os.path.abspath(self.imageName),
+            "operator": self.parentTab.operator,
+            "count_area_type": self.countAreaType,
+            "count_area_bounds": json.dumps(None if self.countAreaBounds is None else [int(b) for b in self.countAreaBounds]),
+            "num_strata": self.numStrata,
+            "confidence": self.confidence,
+            "moe": self.MOE,
+            "neff": float(neff),
+            "area_fraction": float(p_st),
+            "lower_cl": float(lowerCL),
+            "upper_cl": float(upperCL),
+            "num_points": int(self.numGrids),
+            "allocation": self.allocationStrategy,
+            "phase": self.phaseNames[phaseIndex] if len(self.phaseNames) > 0 else None,
+        }
+        strata = {"pixel_count": self.N_h, "weight": self.W_h, "initial_guess": self.phaseGuesses[:, phaseIndex], "num_samples": self.n_h, "area_fraction": p_h}
+        points = {"stratum": self.pointStrata, "row": positions[:, 0], "col": positions[:, 1], "value": self.classValues[self.pointClasses, phaseIndex]}
+        measurementId = self.parentTab.resultsStore.AddMeasurement(measurement, strata, points)
+        self.parentTab.setupWidget.measurementIds.append(measurementId)
+
+    def UpdateDisplay(self):
+        displayImage = self.viewportCache.Get((self.gridIndex, self.numSurroundingPixels, self.displayToggle))
 
-            p_st = np.sum(p_h) * W_h
-            lowerCL, upperCL = scipy.stats.binom.interval(self.confidence, self.neff, p_st) # NOTE: Scipy interval returns number of successes
-            lowerCL /= self.neff
-            upperCL /= self.neff
+        self.sc.ShowImage(displayImage)
 
-            
-            self.parentTab.MoveToSetupWidget(p_st, lowerCL, upperCL)
+        self.viewportCache.Prefetch(self.GetPrefetchKeys())
 
-            return
+        # Percentiles are only recomputed every few frames to keep the overlay cheap
+        self.profileFrames += 1
+        if self.profileText.isVisible() and self.profileFrames % 10 == 0:
+            self.UpdateProfileText()
 
-        self.indexProgressText.setText(f"Sample: {self.sampleIndex+1}/{self.n_h[self.strataIndex]}, Strata: {self.strataIndex+1}/{self.numStrata}")
+    def UpdateProfileText(self):
+        self.profileText.setText(profiler.GetSummaryText() or "No timings yet")
+        self.profileText.adjustSize()
+        self.profileText.raise_()
 
-        self.UpdateDisplay()
+    def GetPrefetchKeys(self) -> list:
+        # Next samples in counting order first, then the previous sample and the current one at neighbouring zooms and styles
+        keys = [(gridIndex, self.numSurroundingPixels, self.displayToggle) for gridIndex in range(self.gridIndex + 1, min(self.gridIndex + 1 + self.numPrefetch, self.numGrids))]
 
-    def UpdateDisplay(self):
-        displayImage = self.myMap.GetImageWithGridOverlay(self.samplePositions[self.strataIndex][self.sampleIndex][0], self.samplePositions[self.strataIndex][self.sampleIndex][1], (50, 225, 248), self.numSurroundingPixels, self.displayToggle)
+        if self.gridIndex > 0:
+            keys.append((self.gridIndex - 1, self.numSurroundingPixels, self.displayToggle))
 
-        self.sc.axes.cla()
-        self.sc.axes.imshow(displayImage)
-        self.sc.axes.set_yticks([])
-        self.sc.axes.set_xticks([])
-        self.sc.draw()
+        keys.append((self.gridIndex, self.numSurroundingPixels, (self.displayToggle + 1) % 3))
+        if self.numSurroundingPixels > 25:
+            keys.append((self.gridIndex, self.numSurroundingPixels - 25, self.displayToggle))
+        if self.numSurroundingPixels < 300:
+            keys.append((self.gridIndex, self.numSurroundingPixels + 25, self.displayToggle))
+
+        return keys
 
     def ToggleDisplay(self):
         
@@ -1219,7 +2866,7 @@ class ConstituentCountingWidget(QtWidgets.QWidget):
 
 class MyWindow(QtWidgets.QMainWindow):
 
-    def __init__(self):
+    def __init__(self, databasePath:str="RAFTResults.db"):
         super(MyWindow,self).__init__()
 
         self.setWindowTitle("RAFT")
@@ -1230,6 +2877,14 @@ class MyWindow(QtWidgets.QMainWindow):
         self.stackedWidget = QtWidgets.QStackedWidget()
         self.setCentralWidget(self.stackedWidget)
 
+        self.imageStore = ImageStore()
+        self.imageQueue = ImageQueue()
+        self.resultsStore = ResultsStore(databasePath)
+        self.sessionJournal = SessionJournal()
+        self.operator = getpass.getuser()
+        self.shareAddress = ("127.0.0.1", 5577) # where a shared count listens for other instances
+        self.shareToken = secrets.token_urlsafe(6) # instances joining a count shared here must send it
+
         self.setupWidget = SetupWidget(self)
         self.initalGuessWidget = InitialGuessWidget(self)
         self.constituentCountingWidget = ConstituentCountingWidget(self)
@@ -1244,13 +2899,101 @@ class MyWindow(QtWidgets.QMainWindow):
 
         self.stackedWidget.setFocus(QtCore.Qt.NoFocusReason)
 
-    def MoveToSetupWidget(self, p_st=None, lowerCL=None, upperCL=None):
+    def closeEvent(self, event):
+        profiler.Dump()
+        self.imageQueue.Shutdown()
+        self.constituentCountingWidget.CloseSharedCounting()
+        self.resultsStore.Close()
+        self.sessionJournal.Close() # kept on disk so an unfinished count can be resumed
+        super(MyWindow, self).closeEvent(event)
+
+    def OfferResume(self):
+        # Offer to pick an unfinished count back up where it stopped
+        journal = self.sessionJournal.Load()
+        if journal is None:
+            return
+        header, values = journal
+        if not os.path.isfile(header["imagePath"]):
+            print(f"Cannot resume session, {header['imagePath']} no longer exists")
+            return
+
+        answer = QtWidgets.QMessageBox.question(self, "Resume Session", f"Resume the unfinished count of {os.path.basename(header['imagePath'])} ({len(values)} entries recorded)?")
+        if answer != QtWidgets.QMessageBox.Yes:
+            return
+
+        # Result table entries read the image name and CI from the setup widget
+        self.setupWidget.imagePathBox.setText(header["imagePath"])
+        self.setupWidget.setCIbox.setText(f"{header['confidence']*100:g}")
+        self.setupWidget.setMOEbox.setText(f"{header['MOE']*100:g}")
+
+        self.stackedWidget.setCurrentIndex(2)
+        self.constituentCountingWidget.ResumeCounting(header, values)
+
+    def ShowMessage(self, title:str, text:str, icon=QtWidgets.QMessageBox.Critical):
+        msg = QtWidgets.QMessageBox()
+        msg.setIcon(icon)
+        msg.setText(title)
+        msg.setInformativeText(text)
+        msg.setWindowTitle(title)
+        msg.exec_()
+
+    def JoinSharedCount(self, address:str, token:str):
+        # Counts chunks of the plan of another instance, the image has to be readable at the same path here
+        try:
+            client = CountingClient(*CountingCoordinator.ParseAddress(address), self.operator, token)
+        except (OSError, ValueError, KeyError) as e:
+            self.ShowMessage("Error", f"Cannot join the shared count at {address}: {e}")
+            return
+        if not os.path.isfile(client.plan["imagePath"]):
+            self.ShowMessage("Error", f"Cannot join the shared count, {client.plan['imagePath']} does not exist here")
+            client.Close()
+            return
+
+        self.setWindowTitle(f"RAFT - {os.path.basename(client.plan['imagePath'])} (shared)")
+        self.stackedWidget.setCurrentIndex(2)
+        self.constituentCountingWidget.JoinSharedCounting(client)
+
+    def MoveToSetupWidget(self, p_st=None, lowerCL=None, upperCL=None, phaseNames=None):
+        # With phaseNames the results hold one entry per phase
         if p_st is not None:
-            self.setupWidget.AddResultsToTable(p_st, lowerCL, upperCL)
+            if phaseNames is None:
+                self.setupWidget.AddResultsToTable(p_st, lowerCL, upperCL)
+            else:
+                for phaseName, p, lower, upper in zip(phaseNames, p_st, lowerCL, upperCL):
+                    self.setupWidget.AddResultsToTable(p, lower, upper, phaseName)
+            if self.StartNextQueuedImage():
+                return
+        if len(self.imageQueue.skipped) > 0:
+            skipped = "\n".join(f"{os.path.basename(imagePath)}: {reason}" for imagePath, reason in self.imageQueue.skipped)
+            self.ShowMessage("Skipped Images", f"{len(self.imageQueue.skipped)} queued images could not be read and were skipped:\n{skipped}", QtWidgets.QMessageBox.Warning)
+        self.setupWidget.SetQueue([])
+        self.setWindowTitle("RAFT")
         self.setupWidget.Clear()
         self.stackedWidget.setCurrentIndex(0)
 
-    def MoveToInitialGuessWidget(self):
+    def StartNextQueuedImage(self) -> bool:
+        # Queued images go straight to their initial guesses with the settings of the first one
+        while self.imageQueue.HasNext():
+            imagePath, future = self.imageQueue.Advance()
+            try:
+                prepared = future.result() if future is not None else None
+                self.setupWidget.imagePathBox.setText(imagePath) # result table entries read the image name from the setup widget
+                self.MoveToInitialGuessWidget(prepared)
+                return True
+            except (OSError, ValueError) as e: # unreadable or undecodable files, including those decoded in the background
+                self.imageQueue.skipped.append((imagePath, str(e)))
+        return False
+
+    def PrefetchQueuedImage(self, numStrata, countAreaType, countAreaBounds, layout):
+        # The next queued image is decoded and its strata, automatic estimates and previews made while this one is counted
+        guessWidget = self.initalGuessWidget
+        try:
+            threshold = guessWidget.GetThreshold()
+        except ValueError: # reported once the box is edited, the next image is estimated with Otsu meanwhile
+            threshold = None
+        self.imageQueue.Prefetch(guessWidget.PrepareImage, numStrata, countAreaType, countAreaBounds, layout, threshold, guessWidget.phaseBox.currentIndex() == 0, max(guessWidget.sc.get_width_height()))
+
+    def MoveToInitialGuessWidget(self, prepared=None):
         # Gather data
         imagePath = self.setupWidget.imagePathBox.text()
         
@@ -1262,18 +3005,36 @@ class MyWindow(QtWidgets.QMainWindow):
             countAreaType = "Circular"
         elif self.setupWidget.selectAnnularCropButton.isChecked():
             countAreaType = "Annular"
+        elif self.setupWidget.selectPolygonCropButton.isChecked():
+            countAreaType = "Polygon"
         
-        # value will be none, array of length 3 (circ crop), or array of length 4 (rect or annular crop)
+        # value will be none, array of length 3 (circ crop), array of length 4 (rect or annular crop) or vertex coordinates (polygon crop)
         countAreaBounds = self.setupWidget.countAreaBounds
 
-        numStrata = 16
+        try:
+            numStrata, layout = self.setupWidget.GetStrataLayout(countAreaType)
+            phaseNames, phaseKeys = ConstituentCountingWidget.ParsePhases(self.setupWidget.setPhasesBox.text())
+        except ValueError as e:
+            msg = QtWidgets.QMessageBox()
+            msg.setIcon(QtWidgets.QMessageBox.Critical)
+            msg.setText("Error")
+            msg.setInformativeText(str(e))
+            msg.setWindowTitle("Error")
+            msg.exec_()
+            return
+        self.constituentCountingWidget.SetPhases(phaseNames, phaseKeys)
         
         # Initialize the initial guess widget
-        self.initalGuessWidget.ReadImage(imagePath, numStrata, countAreaType, countAreaBounds)
+        self.initalGuessWidget.ReadImage(imagePath, numStrata, countAreaType, countAreaBounds, layout, prepared)
 
         # change active widget
         self.stackedWidget.setCurrentIndex(1)
 
+        if self.imageQueue.IsActive():
+            numSkipped = len(self.imageQueue.skipped)
+            self.setWindowTitle(f"RAFT - {os.path.basename(imagePath)} ({self.imageQueue.index + 1} of {len(self.imageQueue.paths)}" + (f", {numSkipped} skipped)" if numSkipped > 0 else ")"))
+            self.PrefetchQueuedImage(numStrata, countAreaType, countAreaBounds, layout)
+
     def MoveToConstituentCountWidget(self):
         # Get required values
         if self.setupWidget.selectFullImageButton.isChecked():
@@ -1284,8 +3045,10 @@ class MyWindow(QtWidgets.QMainWindow):
             countAreaType = "Circular"
         elif self.setupWidget.selectAnnularCropButton.isChecked():
             countAreaType = "Annular"
+        elif self.setupWidget.selectPolygonCropButton.isChecked():
+            countAreaType = "Polygon"
 
-        # value will be none, array of length 3 (circ crop), or array of length 4 (rect or annular crop)
+        # value will be none, array of length 3 (circ crop), array of length 4 (rect or annular crop) or vertex coordinates (polygon crop)
         countAreaBounds = self.setupWidget.countAreaBounds
 
         initialGuesses = np.array(self.initalGuessWidget.initialGuesses)
@@ -1294,19 +3057,256 @@ class MyWindow(QtWidgets.QMainWindow):
         imagePath = self.setupWidget.imagePathBox.text()
 
         # Initialize widget
-        self.constituentCountingWidget.InitializeCounting(initialGuesses, imagePath, countAreaType, countAreaBounds, confidence, moe)
+        self.constituentCountingWidget.allocationStrategy = self.setupWidget.setAllocationBox.currentText()
+        self.constituentCountingWidget.sequentialStopping = self.setupWidget.stopEarlyBox.isChecked()
+        self.constituentCountingWidget.sharedAddress = self.shareAddress if self.setupWidget.shareBox.isChecked() else None
+        try:
+            self.constituentCountingWidget.InitializeCounting(initialGuesses, imagePath, countAreaType, countAreaBounds, confidence, moe, self.initalGuessWidget.strataMap)
+        except ValueError as e:
+            msg = QtWidgets.QMessageBox()
+            msg.setIcon(QtWidgets.QMessageBox.Critical)
+            msg.setText("Error")
+            msg.setInformativeText(str(e))
+            msg.setWindowTitle("Error")
+            msg.exec_()
+            return
 
         # Change active widget
         self.stackedWidget.setCurrentIndex(2)
 
 
+# Number of phase (nonzero) pixels of a binary mask in each stratum, read in bands of rows to bound memory
+def CountPhasePixels(mask, strataMap:StrataMap) -> np.ndarray:
+    numStrata = strataMap.numStrata
+    leftBound = int(np.min(strataMap.leftBounds))
+    rightBound = int(np.max(strataMap.rightBounds))
+    topBound = int(np.min(strataMap.topBounds))
+    bottomBound = int(np.max(strataMap.bottomBounds))
+    bandRows = max(1, 2**24 // max(rightBound - leftBound, 1))
+
+    phaseCounts = np.zeros(numStrata)
+    for bandTop in range(topBound, bottomBound, bandRows):
+        bandBottom = min(bandTop + bandRows, bottomBound)
+        band = np.asarray(mask[bandTop:bandBottom, leftBound:rightBound])
+        if band.ndim == 3:
+            band = band[:, :, :3].any(axis=2) # any nonzero color channel marks the phase, alpha is ignored
+        labels = strataMap.GetLabels(leftBound, rightBound, bandTop, bandBottom)
+        inside = labels >= 0
+        phaseCounts += np.bincount(labels[inside], weights=band[inside] > 0, minlength=numStrata)
+
+    return phaseCounts
+
+
+# Approximate phase fraction of every stratum from a threshold on a downsampled view of the count area
+# threshold is on the 0-255 display scale, Otsu's level is used when it is None. Returns the fractions and the level used
+def EstimatePhaseFractions(pixelMap:PixelMap, strataMap:StrataMap, threshold=None, darkPhase:bool=True, maxSize:int=1024) -> tuple:
+    numStrata = strataMap.numStrata
+    leftBound = int(np.min(strataMap.leftBounds))
+    rightBound = int(np.max(strataMap.rightBounds))
+    topBound = int(np.min(strataMap.topBounds))
+    bottomBound = int(np.max(strataMap.bottomBounds))
+    step = max(1, -(-max(bottomBound - topBound, rightBound - leftBound) // maxSize))
+
+    image = pixelMap.GetCroppedImage(leftBound, rightBound, topBound, bottomBound, step)
+    if image.ndim == 3:
+        image = np.mean(image[:, :, :3], axis=2).astype(np.uint8) # alpha is ignored
+    labels = strataMap.GetLabels(leftBound, rightBound, topBound, bottomBound)[::step, ::step]
+    inside = labels >= 0
+    values = image[inside]
+    labels = labels[inside]
+
+    if threshold is None:
+        threshold, _ = cv2.threshold(values.reshape(-1, 1), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    phase = values <= threshold if darkPhase else values > threshold
+
+    phaseCounts = np.bincount(labels, weights=phase, minlength=numStrata)
+    counts = np.bincount(labels, minlength=numStrata)
+    fractions = np.divide(phaseCounts, counts, out=np.full(numStrata, 0.5), where=counts > 0)
+
+    # Kept within the range of the guess buttons, a guess of exactly 0 or 1 would leave its stratum no variance to plan for
+    return np.clip(fractions, 0.05, 0.95), float(threshold)
+
+
+# Exact per-stratum and total area fractions of a binary mask
+def ComputeReferenceFractions(maskPath:str, numStrata:int, countAreaType:str, countAreaBounds=None, layout=None) -> tuple:
+    mask = ImageStore().OpenImage(maskPath)
+    rows, cols = mask.shape[:2]
+    strataMap = StrataMap(rows, cols, numStrata, countAreaType, countAreaBounds, layout)
+    numStrata = strataMap.numStrata
+    phaseCounts = CountPhasePixels(mask, strataMap)
+
+    if isinstance(mask, TiledImageSource):
+        mask.Close()
+
+    p_h = np.divide(phaseCounts, strataMap.counts, out=np.zeros(numStrata), where=strataMap.counts > 0)
+    p_st = np.sum(phaseCounts) / strataMap.N
+    return p_h, p_st
+
+
+# Sorted paths of the images in a directory
+def ListImages(directory:str) -> list:
+    extensions = (".png", ".tif", ".tiff", ".bmp", ".jpg", ".jpeg", ".npy")
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(extensions))
+
+
+# Compute reference area fractions for every mask in a directory across a process pool and write them to one csv
+def RunBatch(maskDirectory:str, outputPath:str, numStrata:int, countAreaType:str, countAreaBounds=None, numWorkers=None, layout=None):
+    maskPaths = ListImages(maskDirectory)
+
+    with ProcessPoolExecutor(max_workers=numWorkers) as executor, open(outputPath, "w", newline="") as file:
+        writer = csv.writer(file)
+        numColumns = None # strata of the first mask, polygon areas drop the grid cells outside the polygon so this can be below numStrata
+
+        futures = [executor.submit(ComputeReferenceFractions, maskPath, numStrata, countAreaType, countAreaBounds, layout) for maskPath in maskPaths]
+        numWritten = 0
+        for maskPath, future in zip(maskPaths, futures):
+            try:
+                p_h, p_st = future.result()
+            except Exception as e:
+                print(f"Skipping {maskPath}: {e}")
+                continue
+            if numColumns is None:
+                numColumns = len(p_h)
+                writer.writerow(["Image Name", "Area Fraction"] + [f"Stratum {i+1}" for i in range(numColumns)])
+            elif len(p_h) != numColumns:
+                print(f"Skipping {maskPath}: {len(p_h)} strata instead of the {numColumns} of the first mask")
+                continue
+            writer.writerow([os.path.basename(maskPath), f"{p_st:.6f}"] + [f"{p:.6f}" for p in p_h])
+            file.flush()
+            numWritten += 1
+
+    print(f"Wrote reference area fractions for {numWritten} of {len(maskPaths)} masks to {outputPath}")
+
+
+# Monte Carlo check of the reported CI against a ground truth mask. Every replicate plan draws n_h distinct pixels
+# from each stratum, so the number of phase pixels counted is hypergeometric and all replicates are drawn in one call
+def SimulateCoverage(maskPath:str, numStrata:int, countAreaType:str, countAreaBounds=None, confidence:float=0.95, MOE:float=0.05, numReplicates:int=10000, initialGuesses=None, seed=None, allocation:str="Equal", layout=None) -> dict:
+    mask = ImageStore().OpenImage(maskPath)
+    rows, cols = mask.shape[:2]
+    strataMap = StrataMap(rows, cols, numStrata, countAreaType, countAreaBounds, layout)
+    numStrata = strataMap.numStrata
+    phaseCounts = CountPhasePixels(mask, strataMap).astype(np.int64)
+
+    if isinstance(mask, TiledImageSource):
+        mask.Close()
+
+    N_h = strataMap.counts.astype(np.int64)
+    W_h = strataMap.W_h
+    p_h = np.divide(phaseCounts, N_h, out=np.zeros(numStrata), where=N_h > 0)
+    p_true = np.sum(phaseCounts) / strataMap.N
+
+    # Default to the guesses a user would make, the closest button to each true stratum fraction
+    if initialGuesses is None:
+        levels = np.array([0.05, 0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 0.95])
+        initialGuesses = levels[np.argmin(np.abs(p_h[:, None] - levels[None, :]), axis=1)]
+    initialGuesses = np.asarray(initialGuesses, dtype=float)
+
+    neff, n_h = SampleSizeSolver.Plan(initialGuesses, W_h, MOE, confidence, allocation)
+    SampleSizeSolver.CheckFits(n_h, N_h) # the same plans the GUI refuses are not simulated
+
+    rng = np.random.default_rng(seed)
+    successes = rng.hypergeometric(phaseCounts, N_h - phaseCounts, n_h, size=(numReplicates, numStrata))
+    p_h_hat = np.divide(successes, n_h, out=np.zeros(successes.shape), where=n_h > 0)
+    p_st_hat = p_h_hat @ W_h
+
+    lowerCL, upperCL = scipy.stats.binom.interval(confidence, neff, p_st_hat)
+    lowerCL /= neff
+    upperCL /= neff
+    covered = (lowerCL <= p_true) & (p_true <= upperCL)
+
+    return {
+        "p_true": p_true,
+        "coverage": np.mean(covered),
+        "coverageStdErr": np.sqrt(np.mean(covered) * (1 - np.mean(covered)) / numReplicates),
+        "bias": np.mean(p_st_hat) - p_true,
+        "rmse": np.sqrt(np.mean((p_st_hat - p_true)**2)),
+        "meanHalfWidth": np.mean(upperCL - lowerCL) / 2,
+        "neff": neff,
+        "n_h": n_h,
+        "numSamples": int(np.sum(n_h)),
+        "numReplicates": numReplicates,
+    }
+
+
 def main():
-    app = QtWidgets.QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="RAFT")
+    parser.add_argument("--batch", metavar="MASK_DIR", help="compute reference area fractions for every binary mask in a directory without the GUI")
+    parser.add_argument("--output", default="ReferenceAreaFractions.csv", help="csv written by --batch")
+    parser.add_argument("--count-area", default="Full", choices=["Full", "Rectangular", "Circular", "Annular", "Polygon"])
+    parser.add_argument("--bounds", help="count area bounds in pixels: x,y,width,height (rectangular), center_x,center_y,radius (circular) or center_x,center_y,inner_radius,outer_radius (annular) or x0,y0,x1,y1,... vertices (polygon)")
+    parser.add_argument("--strata", default="16", help="number of strata N, or a layout RxC of grid rows by columns (rings by sectors for circular and annular areas)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the number of CPUs")
+    parser.add_argument("--simulate", metavar="MASK_PATH", help="estimate the coverage of the reported CI by Monte Carlo against a ground truth binary mask")
+    parser.add_argument("--ci", type=float, default=95, help="confidence level in percent used by --simulate")
+    parser.add_argument("--moe", type=float, default=5, help="margin of error in percent used by --simulate")
+    parser.add_argument("--replicates", type=int, default=10000, help="number of replicate sample plans drawn by --simulate")
+    parser.add_argument("--seed", type=int, default=None, help="random seed used by --simulate")
+    parser.add_argument("--allocation", default="Equal", choices=["Equal", "Neyman"], help="allocation of samples across strata used by --simulate")
+    parser.add_argument("--export", metavar="CSV_PATH", help="export stored measurements to a csv without the GUI")
+    parser.add_argument("--export-points", metavar="CSV_PATH", help="export the individual points of stored measurements to a csv without the GUI")
+    parser.add_argument("--database", default="RAFTResults.db", help="results database")
+    parser.add_argument("--image", help="only export measurements of this image name")
+    parser.add_argument("--operator", help="only export measurements by this operator, or with the GUI the operator recorded with each measurement")
+    parser.add_argument("--since", help="only export measurements made on or after this ISO date")
+    parser.add_argument("--until", help="only export measurements made before this ISO date")
+    parser.add_argument("--queue", nargs="+", metavar="PATH", help="images, or folders of images, to count one after another with the same settings")
+    parser.add_argument("--share-address", metavar="HOST:PORT", help="address a count shared with Share listens on, defaults to 127.0.0.1:5577 which only this machine can join, 0.0.0.0:PORT accepts other machines")
+    parser.add_argument("--join", metavar="HOST:PORT", help="join the shared count of another RAFT instance at startup")
+    parser.add_argument("--share-token", metavar="TOKEN", help="token a shared count asks of instances joining it, or that --join sends, a random one is shown when sharing starts if not given")
+    parser.add_argument("--profile", nargs="?", const="RAFTProfile.json", metavar="PATH", help="time decode, plan, overlay, draw and key-to-frame latency, press P while counting for an overlay, percentiles are written to PATH on exit")
+    args, qtArgs = parser.parse_known_args()
+
+    if args.export is not None or args.export_points is not None:
+        resultsStore = ResultsStore(args.database)
+        filters = {"imageName": args.image, "operator": args.operator, "since": args.since, "until": args.until}
+        if args.export is not None:
+            print(f"Exported {resultsStore.ExportMeasurementsCsv(args.export, **filters)} measurements to {args.export}")
+        if args.export_points is not None:
+            print(f"Exported {resultsStore.ExportPointsCsv(args.export_points, **filters)} points to {args.export_points}")
+        resultsStore.Close()
+        return
+
+    if args.profile is not None:
+        profiler.Enable(args.profile)
+
+    numStrata, layout = StrataMap.ParseLayout(args.strata, args.count_area)
+
+    if args.simulate is not None:
+        countAreaBounds = [int(n) for n in args.bounds.split(",")] if args.bounds else None
+        try:
+            result = SimulateCoverage(args.simulate, numStrata, args.count_area, countAreaBounds, args.ci / 100, args.moe / 100, args.replicates, seed=args.seed, allocation=args.allocation, layout=layout)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"True area fraction: {result['p_true']*100:.2f}%")
+        print(f"Samples per stratum: {', '.join(str(n) for n in result['n_h'])} ({result['numSamples']} total, neff {result['neff']:.0f})")
+        print(f"Coverage of {args.ci:.0f}% CI: {result['coverage']*100:.2f}% +- {result['coverageStdErr']*100:.2f}% over {result['numReplicates']} replicates")
+        print(f"Bias: {result['bias']*100:.3f}%, RMSE: {result['rmse']*100:.3f}%, mean CI half width: {result['meanHalfWidth']*100:.2f}%")
+        return
+
+    if args.batch is not None:
+        countAreaBounds = [int(n) for n in args.bounds.split(",")] if args.bounds else None
+        RunBatch(args.batch, args.output, numStrata, args.count_area, countAreaBounds, args.workers, layout)
+        return
+
+    app = QtWidgets.QApplication(sys.argv[:1] + qtArgs)
     app.setStyle("Fusion")
 
-    win = MyWindow()
+    win = MyWindow(args.database)
+    if args.operator is not None:
+        win.operator = args.operator
+    if args.queue is not None:
+        win.setupWidget.SetQueue([path for queuePath in args.queue for path in (ListImages(queuePath) if os.path.isdir(queuePath) else [queuePath])])
+
+    if args.share_address is not None:
+        win.shareAddress = CountingCoordinator.ParseAddress(args.share_address)
+    if args.share_token is not None:
+        win.shareToken = args.share_token
 
     win.show()
+    if args.join is not None:
+        win.JoinSharedCount(args.join, win.shareToken)
+    else:
+        win.OfferResume()
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
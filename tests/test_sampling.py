@@ -0,0 +1,150 @@
+# Headless checks of the strata label maps, the stratified sampler and the sample size solver
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from main import ConstituentCountingWidget, SampleSizeSolver, SimulateCoverage, StrataMap
+
+ROWS, COLS = 300, 400
+
+AREAS = [
+    ("Full", None, (4, 4)),
+    ("Full", None, (3, 5)),
+    ("Rectangular", [20, 30, 250, 200], (4, 4)),
+    ("Circular", [200, 150, 120], (1, 16)),
+    ("Circular", [200, 150, 120], (3, 8)),
+    ("Annular", [200, 150, 40, 130], (1, 16)),
+    ("Annular", [200, 150, 40, 130], (2, 6)),
+    ("Polygon", [10, 10, 380, 20, 200, 290], (4, 4)),
+    ("Polygon", [5, 5, 395, 5, 395, 295, 5, 295, 200, 150], (5, 5)),
+]
+
+
+def MakeStrataMap(countAreaType, countAreaBounds, layout):
+    return StrataMap(ROWS, COLS, layout[0] * layout[1], countAreaType, countAreaBounds, layout)
+
+
+@pytest.mark.parametrize("countAreaType, countAreaBounds, layout", AREAS)
+def test_label_counts_match_counts(countAreaType, countAreaBounds, layout):
+    strataMap = MakeStrataMap(countAreaType, countAreaBounds, layout)
+    labels = strataMap.GetLabels(0, COLS, 0, ROWS)
+
+    assert labels.shape == (ROWS, COLS)
+    assert np.array_equal(np.bincount(labels[labels >= 0], minlength=strataMap.numStrata), strataMap.counts)
+    assert np.sum(strataMap.counts) == strataMap.N
+    assert np.all(strataMap.counts > 0)
+
+    # Every stratum lies inside its bounding box
+    for i in range(strataMap.numStrata):
+        leftBound, rightBound, topBound, bottomBound = strataMap.GetBounds(i)
+        rows, cols = np.nonzero(labels == i)
+        assert rows.min() >= topBound and rows.max() < bottomBound
+        assert cols.min() >= leftBound and cols.max() < rightBound
+
+
+@pytest.mark.parametrize("countAreaType, countAreaBounds, layout", AREAS)
+def test_sample_strata_draws_distinct_pixels_of_each_stratum(countAreaType, countAreaBounds, layout):
+    strataMap = MakeStrataMap(countAreaType, countAreaBounds, layout)
+    labels = strataMap.GetLabels(0, COLS, 0, ROWS)
+
+    # A mix of small plans, a plan of half of a stratum and a whole stratum, which take the enumeration path
+    n_h = np.minimum(np.arange(strataMap.numStrata) % 7 + 3, strataMap.counts)
+    n_h[0] = strataMap.counts[0]
+    n_h[-1] = strataMap.counts[-1] // 2
+    rows, cols, strata = strataMap.SampleStrata(n_h, np.random.default_rng(0))
+
+    assert np.array_equal(np.bincount(strata, minlength=strataMap.numStrata), n_h)
+    assert np.all(np.diff(strata) >= 0) # grouped by stratum
+    assert np.array_equal(labels[rows, cols], strata)
+    assert len(np.unique(rows.astype(np.int64) * COLS + cols)) == len(rows)
+
+
+def test_sample_strata_rejects_more_points_than_pixels():
+    strataMap = MakeStrataMap("Circular", [200, 150, 120], (1, 16))
+    n_h = np.ones(strataMap.numStrata, dtype=np.int64)
+    n_h[3] = strataMap.counts[3] + 1
+    with pytest.raises(ValueError):
+        strataMap.SampleStrata(n_h, np.random.default_rng(0))
+
+
+@pytest.mark.parametrize("p_st, MOE, confidence", [(0.5, 0.05, 0.95), (0.1, 0.02, 0.95), (0.3, 0.01, 0.99), (0.02, 0.01, 0.9)])
+def test_effective_sample_size_meets_moe(p_st, MOE, confidence):
+    neff = SampleSizeSolver.EffectiveSampleSize(p_st, MOE, confidence)
+    assert SampleSizeSolver.HalfWidth(neff, p_st, confidence) <= MOE
+    assert SampleSizeSolver.HalfWidth(neff - 1, p_st, confidence) > MOE
+
+
+@pytest.mark.parametrize("allocation", ["Equal", "Neyman"])
+def test_plan_meets_neff(allocation):
+    guesses = np.array([0.1, 0.3, 0.5, 0.05])
+    W_h = np.array([0.4, 0.3, 0.2, 0.1])
+    neff, n_h = SampleSizeSolver.Plan(guesses, W_h, 0.03, 0.95, allocation)
+
+    assert n_h.dtype == np.int64 and np.all(n_h >= 2)
+    p_st = np.sum(W_h * guesses)
+    achieved = p_st * (1 - p_st) / np.sum(W_h**2 * guesses * (1 - guesses) / (n_h - 1))
+    assert achieved >= neff * (1 - 1e-9)
+
+
+def test_plan_sizes_do_not_overflow():
+    _, n_h = SampleSizeSolver.Plan(np.array([0.5]), np.array([1.0]), 0.005, 0.95)
+    assert n_h[0] > 32767
+
+    _, n_h = SampleSizeSolver.Plan(np.array([0.5, 0.05]), np.array([0.9, 0.1]), 0.004, 0.95, "Neyman")
+    assert np.all(n_h > 0) and n_h[0] > 32767
+
+
+def test_simulate_coverage_rejects_more_points_than_pixels(tmp_path):
+    maskPath = str(tmp_path / "mask.npy")
+    np.save(maskPath, np.arange(40 * 40).reshape(40, 40) % 3 == 0)
+    with pytest.raises(ValueError, match="Stratum 1 has 100 pixels"):
+        SimulateCoverage(maskPath, 16, "Full", MOE=0.01, numReplicates=10, seed=0)
+
+    result = SimulateCoverage(maskPath, 4, "Full", MOE=0.1, numReplicates=10, seed=0)
+    assert np.all(result["n_h"] <= 400)
+
+def MakeCountingState(numStrata, guess, MOE):
+    # Just the state GetLiveEstimate and CanStopEarly read, in the single phase mode
+    state = SimpleNamespace(classValues=np.array([[0], [0.5], [1]]), W_h=np.full(numStrata, 1 / numStrata), confidence=0.95, MOE=MOE,
+                            phaseGuesses=np.full((numStrata, 1), guess), sequentialStopping=True, minSamplesPerStratum=5)
+    state.n_h = SampleSizeSolver.Plan(np.full(numStrata, guess), state.W_h, MOE, 0.95)[1]
+    state.stratumCounts = np.zeros(numStrata, dtype=np.int64)
+    state.stratumClassCounts = np.zeros((numStrata, 3), dtype=np.int64)
+    state.GetLiveEstimate = lambda *counts: ConstituentCountingWidget.GetLiveEstimate(state, *counts)
+    return state
+
+
+def test_live_ci_does_not_collapse_when_every_point_is_zero():
+    state = MakeCountingState(16, 0.05, 0.02)
+    state.stratumCounts[:] = 5
+    state.stratumClassCounts[:, 0] = 5
+
+    _, p_st, lowerCL, upperCL, neff = state.GetLiveEstimate()
+    assert p_st[0] == 0 and lowerCL[0] == 0
+    assert upperCL[0] > 0.02
+    assert neff[0] < 80 * 2
+    assert not ConstituentCountingWidget.CanStopEarly(state)
+
+
+def test_early_stop_covers_a_rare_phase():
+    # A 1% phase planned from 5% guesses, the stop rule must not end at the minimum points with an empty CI
+    rng = np.random.default_rng(1)
+    numCovered, stops = 0, []
+    for _ in range(40):
+        state = MakeCountingState(16, 0.05, 0.02)
+        strata = np.repeat(np.arange(16), state.n_h)
+        for numPoints, stratum in enumerate(strata[ConstituentCountingWidget.GetInterleavedOrder(strata)], start=1):
+            state.stratumCounts[stratum] += 1
+            state.stratumClassCounts[stratum, 2 if rng.random() < 0.01 else 0] += 1
+            if ConstituentCountingWidget.CanStopEarly(state):
+                break
+        _, _, lowerCL, upperCL, _ = state.GetLiveEstimate()
+        numCovered += lowerCL[0] <= 0.01 <= upperCL[0]
+        stops.append(numPoints)
+
+    assert min(stops) > 16 * 5
+    assert numCovered / 40 >= 0.9